@@ -0,0 +1,585 @@
+from __future__ import print_function
+import bz2
+import gzip
+import mmap
+import logging
+import threading
+import subprocess
+import collections
+import struct
+import zlib
+import os.path
+from Queue import Queue, Empty
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+
+# Available backends for decompressing FASTQ files
+DECOMPRESSION_MODES = ("builtin", "thread", "external")
+
+# Backend used when no mode is specified (can be changed by enrich.py)
+default_decompression = "builtin"
+
+# Multi-threaded external decompressors, in order of preference
+EXTERNAL_TOOLS = {
+        'gz' : (("pigz", "-dc"), ("unpigz", "-c")),
+        'bz2' : (("lbzip2", "-dc"), ("pbzip2", "-dc"))
+}
+
+# Compression formats for output files, with their file extensions
+OUTPUT_COMPRESSION = {
+        'gz' : ".gz",
+        'bgzf' : ".gz",
+        'bz2' : ".bz2"
+}
+
+# Number of bytes read by each background thread request
+CHUNK_SIZE = 1048576
+
+# Maximum number of decompressed chunks held in memory ahead of the parser
+MAX_CHUNKS = 16
+
+# Number of blocks decompressed concurrently by the "thread" backend
+THREADS = 4
+
+# Signature at the start of every bz2 stream (compression level is a wildcard)
+_BZ2_STREAM_START = "1AY&SY"
+
+# BGZF format constants (see the SAM/BAM format specification)
+BGZF_MAGIC = "\x1f\x8b\x08\x04"
+BGZF_SUBFIELD = "BC\x02\x00"
+BGZF_HEADER_SIZE = 18
+BGZF_BLOCK_SIZE = 65280   # maximum uncompressed bytes per block
+BGZF_MAX_CDATA = 65536 - BGZF_HEADER_SIZE - 8
+BGZF_EOF = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" \
+           "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+
+def set_default_decompression(mode):
+    """
+    Sets the decompression backend used when none is specified. The *mode*
+    must be one of the values in ``DECOMPRESSION_MODES``.
+    """
+    global default_decompression
+    if mode not in DECOMPRESSION_MODES:
+        raise ValueError("unrecognized decompression mode '{mode}'".format(mode=mode))
+    default_decompression = mode
+
+
+def find_external_tool(compression):
+    """
+    Returns the argument list for the first multi-threaded decompressor for
+    *compression* (``"gz"`` or ``"bz2"``) found on the ``PATH``, or ``None``
+    if no tool is available.
+    """
+    for tool in EXTERNAL_TOOLS[compression]:
+        path = find_executable(tool[0])
+        if path is not None:
+            return [path] + list(tool[1:])
+    return None
+
+
+def strip_compression_extension(fname):
+    """
+    Returns *fname* without a trailing ``.gz`` or ``.bz2`` extension.
+    """
+    base, ext = os.path.splitext(fname)
+    if ext.lower() in (".gz", ".bz2"):
+        return base
+    else:
+        return fname
+
+
+def open_output(fname, compression=None, threaded=False, level=6):
+    """
+    Opens the file *fname* for writing and returns a file-like object 
+    supporting ``write`` and ``close``. The *compression* format is one of 
+    the keys in ``OUTPUT_COMPRESSION`` (``"gz"``, ``"bgzf"``, or ``"bz2"``), 
+    or ``None`` for an uncompressed file. BGZF_ output can be read by any 
+    gzip program, and can also be indexed and decompressed in parallel (see 
+    :py:mod:`~index_fastq`).
+
+    If *threaded* is ``True``, compression and writing happen in a 
+    background thread (see :py:class:`ThreadedWriter`).
+    """
+    if compression is None:
+        handle = open(fname, "wb")
+    elif compression == "gz":
+        handle = gzip.GzipFile(fname, "wb", compresslevel=level)
+    elif compression == "bgzf":
+        handle = BgzfWriter(fname, level=level)
+    elif compression == "bz2":
+        handle = bz2.BZ2File(fname, "w", compresslevel=9)
+    else:
+        raise ValueError("unrecognized compression mode '{mode}'".format(mode=compression))
+    if threaded:
+        return ThreadedWriter(handle)
+    else:
+        return handle
+
+
+def open_compressed(fname, compression, decompression=None, offset=0):
+    """
+    Opens the file *fname* for reading using the requested *decompression*
+    backend and returns a file-like object supporting ``read`` and
+    ``close``. The *compression* format is ``"gz"``, ``"bz2"``, or ``None``
+    (as returned by :py:func:`~fqread.check_fastq`).
+
+    The backends are:
+
+    * ``"builtin"`` --- decompress using :py:mod:`gzip` or :py:mod:`bz2` in \
+        the calling thread
+    * ``"thread"`` --- decompress in a background thread that stays ahead \
+        of the caller. Multi-stream ``.bz2`` files (such as those written by \
+        ``pbzip2``) and BGZF_ files have their blocks decompressed \
+        concurrently
+    * ``"external"`` --- pipe the file through a multi-threaded external \
+        program (``pigz``, ``lbzip2``, or ``pbzip2``). Falls back to \
+        ``"thread"`` if no program is found
+
+    If *decompression* is ``None``, the module's ``default_decompression``
+    is used. Uncompressed files are always opened directly.
+
+    Reading begins at *offset*, which is a byte offset for uncompressed 
+    files or a virtual offset for BGZF_ files (see :py:func:`open_bgzf`). 
+    Other compressed files can only be read from the start.
+    """
+    if decompression is None:
+        decompression = default_decompression
+    if decompression not in DECOMPRESSION_MODES:
+        raise ValueError("unrecognized decompression mode '{mode}'".format(mode=decompression))
+
+    if compression is None: # raw FASTQ
+        handle = open(fname, "rU")
+        handle.seek(offset)
+        return handle
+    elif compression not in ("gz", "bz2"):
+        raise IOError("unrecognized compression mode '{mode}'".format(mode=compression))
+
+    bgzf = compression == "gz" and is_bgzf(fname)
+    if offset > 0 and not bgzf:
+        raise IOError("random access requires a BGZF file ('{fname}')".format(fname=fname))
+
+    if decompression == "external":
+        command = find_external_tool(compression)
+        if command is not None and offset == 0:
+            return ExternalReader(command + [fname])
+        else:
+            if command is None:
+                logging.warning("No external decompressor found for "
+                                "'{fname}', using background thread".format(
+                                fname=fname))
+            decompression = "thread"
+
+    if decompression == "thread":
+        if bgzf:
+            return ThreadedReader(open_bgzf(fname, offset, threads=THREADS))
+        elif compression == "bz2":
+            streams = bz2_streams(fname)
+            if len(streams) > 1:
+                return ThreadedReader(BlockReader(bz2_stream_data(fname, 
+                                      streams), decompress_bz2, 
+                                      threads=THREADS))
+            else:
+                return ThreadedReader(bz2.BZ2File(fname, "r"))
+        else:
+            return ThreadedReader(gzip.GzipFile(fname, "r"))
+    else:
+        if offset > 0: # BGZF
+            return open_bgzf(fname, offset)
+        elif compression == "bz2":
+            return bz2.BZ2File(fname, "rU")
+        else:
+            return gzip.GzipFile(fname, "rU")
+
+
+def bz2_streams(fname):
+    """
+    Returns a list of ``(start, end)`` byte offsets for each bz2 stream in
+    the file *fname*. Files written by parallel compressors contain many
+    independent streams.
+    """
+    starts = list()
+    with open(fname, "rb") as handle:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error): # empty file
+            return list()
+        try:
+            pos = data.find("BZh")
+            while pos != -1:
+                if data[pos + 3:pos + 4].isdigit() and \
+                        data[pos + 4:pos + 10] == _BZ2_STREAM_START:
+                    starts.append(pos)
+                pos = data.find("BZh", pos + 1)
+            size = data.size()
+        finally:
+            data.close()
+    return zip(starts, starts[1:] + [size])
+
+
+class ExternalReader(object):
+    """
+    File-like object for reading the standard output of an external
+    decompression program started with the argument list *command*.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                        bufsize=-1)
+
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+
+    def close(self):
+        if self.process.poll() is None: # closed before reaching the end
+            self.process.terminate()
+            self.process.stdout.close()
+            self.process.wait()
+        else:
+            self.process.stdout.close()
+            if self.process.returncode != 0:
+                raise IOError("'{cmd}' failed with exit code {code}".format(
+                              cmd=" ".join(self.command),
+                              code=self.process.returncode))
+
+
+class BlockReader(object):
+    """
+    File-like object for reading a file made of independently compressed
+    blocks, such as a multi-stream ``.bz2`` file or a BGZF_ file. The
+    *blocks* iterable yields the compressed data for each block in order,
+    and each block is decompressed by calling *decompress*. If *threads* is
+    greater than 0, up to *threads* blocks are decompressed concurrently.
+    The first *skip* bytes of decompressed data are discarded.
+    """
+    def __init__(self, blocks, decompress, threads=0, skip=0):
+        self.blocks = iter(blocks)
+        self.decompress = decompress
+        self.buf = ""
+        self.skip = skip
+        self.pending = collections.deque()
+        if threads > 0:
+            self.pool = ThreadPool(threads)
+            self.window = 2 * threads
+        else:
+            self.pool = None
+            self.window = 1
+        self.fill()
+
+
+    def fill(self):
+        """
+        Keep up to *window* blocks queued for decompression.
+        """
+        while len(self.pending) < self.window:
+            try:
+                data = next(self.blocks)
+            except StopIteration:
+                break
+            if self.pool is None:
+                self.pending.append(data)
+            else:
+                self.pending.append(self.pool.apply_async(self.decompress,
+                                                          (data,)))
+
+
+    def next_block(self):
+        """
+        Returns the decompressed contents of the next block, or an empty
+        string at the end of the file.
+        """
+        data = ""
+        while len(data) == 0 and len(self.pending) > 0: # skip empty blocks
+            if self.pool is None:
+                data = self.decompress(self.pending.popleft())
+            else:
+                data = self.pending.popleft().get()
+            self.fill()
+            if self.skip > 0:
+                data, self.skip = data[self.skip:], max(0, self.skip - len(data))
+        return data
+
+
+    def read(self, size=-1):
+        """
+        Returns *size* bytes, or fewer only at the end of the file.
+        """
+        pieces = [self.buf]
+        length = len(self.buf)
+        while size < 0 or length < size:
+            data = self.next_block()
+            if len(data) == 0:
+                break
+            pieces.append(data)
+            length += len(data)
+        data = "".join(pieces)
+        if size < 0:
+            self.buf = ""
+            return data
+        else:
+            self.buf = data[size:]
+            return data[:size]
+
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+        if hasattr(self.blocks, "close"):
+            self.blocks.close()
+
+
+def bz2_stream_data(fname, streams):
+    """
+    Generator function that yields the compressed data for each of the
+    *streams* in *fname* returned by :py:func:`bz2_streams`.
+    """
+    with open(fname, "rb") as handle:
+        for start, end in streams:
+            handle.seek(start)
+            yield handle.read(end - start)
+
+
+def decompress_bz2(data):
+    """
+    Decompress a single bz2 stream.
+    """
+    return bz2.BZ2Decompressor().decompress(data)
+
+
+def is_bgzf(fname):
+    """
+    Returns ``True`` if *fname* is a gzip file in the BGZF_ format, where
+    the file is made of independently compressed blocks that record their
+    own size.
+    """
+    with open(fname, "rb") as handle:
+        header = handle.read(BGZF_HEADER_SIZE)
+    return len(header) == BGZF_HEADER_SIZE and \
+            header[:4] == BGZF_MAGIC and header[12:16] == BGZF_SUBFIELD
+
+
+def bgzf_blocks(fname, offset=0):
+    """
+    Generator function that yields a tuple containing the file offset and
+    the compressed data (including the header) for each block in the BGZF_
+    file *fname*, beginning with the block at *offset*.
+    """
+    with open(fname, "rb") as handle:
+        handle.seek(offset)
+        while True:
+            header = handle.read(BGZF_HEADER_SIZE)
+            if len(header) == 0:
+                break
+            elif len(header) < BGZF_HEADER_SIZE or \
+                    header[:4] != BGZF_MAGIC or header[12:16] != BGZF_SUBFIELD:
+                raise IOError("invalid BGZF block in '{fname}'".format(fname=fname))
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            data = handle.read(bsize - BGZF_HEADER_SIZE)
+            if len(data) < bsize - BGZF_HEADER_SIZE:
+                raise IOError("truncated BGZF block in '{fname}'".format(fname=fname))
+            yield offset, header + data
+            offset += bsize
+
+
+def decompress_bgzf(block):
+    """
+    Decompress a single BGZF_ block, including the header.
+    """
+    data = zlib.decompress(block[BGZF_HEADER_SIZE:-8], -zlib.MAX_WBITS)
+    if len(data) != struct.unpack("<I", block[-4:])[0]:
+        raise IOError("corrupt BGZF block")
+    return data
+
+
+def open_bgzf(fname, voffset=0, threads=0):
+    """
+    Returns a :py:class:`BlockReader` for the BGZF_ file *fname* beginning
+    at the virtual offset *voffset*. The upper 48 bits of a virtual offset
+    are the file offset of a block, and the lower 16 bits are the offset
+    within the decompressed block.
+    """
+    blocks = (data for _, data in bgzf_blocks(fname, voffset >> 16))
+    return BlockReader(blocks, decompress_bgzf, threads=threads,
+                       skip=voffset & 0xffff)
+
+
+class BgzfWriter(object):
+    """
+    File-like object for writing a BGZF_ file *fname*. Data are compressed
+    in blocks of at most ``BGZF_BLOCK_SIZE`` bytes, and an empty end of file
+    block is written when the file is closed. The output can be read by any
+    gzip program.
+    """
+    def __init__(self, fname, level=6):
+        self.handle = open(fname, "wb")
+        self.level = level
+        self.buf = ""
+        self.coffset = 0 # file offset of the next block
+
+
+    def tell(self):
+        """
+        Returns the virtual offset of the next byte to be written.
+        """
+        return (self.coffset << 16) | len(self.buf)
+
+
+    def write(self, data):
+        if len(self.buf) + len(data) < BGZF_BLOCK_SIZE:
+            self.buf += data
+            return
+        data = self.buf + data
+        pos = 0
+        while len(data) - pos >= BGZF_BLOCK_SIZE:
+            self._write_block(data[pos:pos + BGZF_BLOCK_SIZE])
+            pos += BGZF_BLOCK_SIZE
+        self.buf = data[pos:]
+
+
+    def flush(self):
+        """
+        Compress and write any buffered data as a (short) block.
+        """
+        if len(self.buf) > 0:
+            self._write_block(self.buf)
+            self.buf = ""
+
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        cdata = compressor.compress(data) + compressor.flush()
+        if len(cdata) > BGZF_MAX_CDATA: # incompressible data
+            half = len(data) / 2
+            self._write_block(data[:half])
+            self._write_block(data[half:])
+            return
+        bsize = BGZF_HEADER_SIZE + len(cdata) + 8
+        self.handle.write(BGZF_MAGIC + "\x00\x00\x00\x00\x00\xff\x06\x00" +
+                          BGZF_SUBFIELD + struct.pack("<H", bsize - 1))
+        self.handle.write(cdata)
+        self.handle.write(struct.pack("<iI", zlib.crc32(data),
+                                      len(data) & 0xffffffff))
+        self.coffset += bsize
+
+
+    def close(self):
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+class ThreadedWriter(object):
+    """
+    File-like object that passes data to *handle* in a background thread, 
+    so that compression overlaps with the caller's work. Up to 
+    *max_chunks* calls to :py:meth:`write` are queued. Errors in the 
+    thread are raised by the next call to :py:meth:`write` or 
+    :py:meth:`close`.
+    """
+    def __init__(self, handle, max_chunks=MAX_CHUNKS):
+        self.handle = handle
+        self.queue = Queue(maxsize=max_chunks)
+        self.error = None
+        self.thread = threading.Thread(target=self._consume)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _consume(self):
+        """
+        Write chunks to the handle until ``None`` is received.
+        """
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            elif self.error is None: # discard data after an error
+                try:
+                    self.handle.write(chunk)
+                except Exception as err:
+                    self.error = err
+
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.handle.close()
+        if self.error is not None:
+            raise self.error
+
+
+class ThreadedReader(object):
+    """
+    File-like object that reads from *handle* in a background thread. Up to
+    *max_chunks* chunks of *chunk_size* bytes are read ahead of the caller.
+    """
+    def __init__(self, handle, chunk_size=CHUNK_SIZE, max_chunks=MAX_CHUNKS):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.queue = Queue(maxsize=max_chunks)
+        self.buf = ""
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def _produce(self):
+        """
+        Read chunks from the handle until the end of the file. Errors are
+        passed to the caller through the queue.
+        """
+        try:
+            while not self.stopped.is_set():
+                chunk = self.handle.read(self.chunk_size)
+                self.queue.put(chunk)
+                if len(chunk) == 0:
+                    break
+        except Exception as err:
+            self.queue.put(err)
+
+
+    def read(self, size=-1):
+        """
+        Returns *size* bytes, or fewer only at the end of the file.
+        """
+        pieces = [self.buf]
+        length = len(self.buf)
+        while not self.eof and (size < 0 or length < size):
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            elif len(chunk) == 0:
+                self.eof = True
+            else:
+                pieces.append(chunk)
+                length += len(chunk)
+        data = "".join(pieces)
+        if size < 0:
+            self.buf = ""
+            return data
+        else:
+            self.buf = data[size:]
+            return data[:size]
+
+
+    def close(self):
+        self.stopped.set()
+        while self.thread.is_alive(): # unblock the producer if it is waiting
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                pass
+            self.thread.join(0.01)
+        self.handle.close()
@@ -4,10 +4,22 @@ import sys
 import time
 import os
 import logging
+from itertools import chain
 import numpy as np
 import pandas as pd
 
 
+# Parts of a single mutation in an HGVS variant name, such as 
+# "c.12A>G (p.Lys4Glu)", "n.12_13insAC", or "p.Lys4fs"
+_mutation_re = r"^(?P<nt>[cn]\.(?P<nt_position>\d+)\S*)?" \
+               r"(?: ?\(?(?P<aa>p\.(?:=|(?P<wt_aa>[A-Z][a-z][a-z])" \
+               r"(?P<aa_position>\d+)(?:(?P<mut_aa>[A-Z][a-z][a-z])|fs|\?\?\?)))\)?)?$"
+
+# Columns of the table created by parse_variants
+VARIANT_TABLE_COLUMNS = ['variant', 'mutation', 'nt', 'nt_position', 'aa', 
+                         'aa_position', 'wt_aa', 'mut_aa', 'indel']
+
+
 def fix_filename(s):
     """
     Clean up a filename *s* by removing invalid characters and converting 
@@ -18,6 +30,43 @@ def fix_filename(s):
     return fname
 
 
+def parse_variants(variants):
+    """
+    Parses the HGVS variant names in *variants* (such as the index of a 
+    variant :py:class:`pandas.DataFrame`). Returns a 
+    :py:class:`pandas.DataFrame` with one row for each mutation in each 
+    variant, and the columns:
+
+        * ``'variant'`` --- the variant name
+        * ``'mutation'`` --- the mutation
+        * ``'nt'`` --- the nucleotide change (such as ``c.12A>G``)
+        * ``'nt_position'`` --- the first position of the nucleotide change
+        * ``'aa'`` --- the amino acid change (such as ``p.Lys4Glu``)
+        * ``'aa_position'`` --- the position of the amino acid change
+        * ``'wt_aa'`` --- the wild type amino acid (three-letter code)
+        * ``'mut_aa'`` --- the variant amino acid (three-letter code)
+        * ``'indel'`` --- ``True`` for insertions, deletions, duplications, and frameshifts
+
+    Values that are not part of the mutation (such as the amino acids of a 
+    synonymous change or a frameshift) are ``NaN``. Variants without HGVS 
+    mutations (such as the wild type) have one row, containing only the 
+    variant name.
+    """
+    variants = pd.Series(np.asarray(variants, dtype=object), dtype=object)
+    mutations = variants.str.split(", ")
+    table = pd.DataFrame({'variant' : np.repeat(variants.values, 
+                                                mutations.str.len().values), 
+                          'mutation' : pd.Series(list(chain.from_iterable(mutations.values)), 
+                                                 dtype=object)})
+    parts = table['mutation'].str.extract(_mutation_re, expand=True)
+    for column in parts.columns:
+        table[column] = parts[column]
+    for column in ('nt_position', 'aa_position'):
+        table[column] = table[column].astype(float)
+    table['indel'] = table['mutation'].str.contains("ins|del|dup|fs")
+    return table[VARIANT_TABLE_COLUMNS]
+
+
 class DataContainer(object):
     """
     Abstract class for all data-containing classes 
@@ -34,7 +83,7 @@ class DataContainer(object):
     associated log file output message added to the dictionary.
 
     .. literalinclude:: ../datacontainer.py
-        :lines: 41-56
+        :lines: 90-106
     """
 
     # Note: the following block is referenced by line number above
@@ -45,6 +94,7 @@ class DataContainer(object):
             'min quality' : "single-base quality",
             'avg quality' : "average quality",
             'max mutations' : "excess mutations",
+            'edit prescreen' : "excess edits before alignment",
             'chastity' : "not chaste",
             'remove overlap indels' : "indel in read overlap",
             'merge failure' : "unable to merge reads",
@@ -64,6 +114,7 @@ class DataContainer(object):
         self.filters = None
         self.filter_stats = None
         self.output_base = None
+        self.variant_tables = dict()
         
         try:
             self.name = config['name']
@@ -154,6 +205,28 @@ class DataContainer(object):
             self.df_dict[key] = pd.DataFrame.from_csv(self.df_files[key], sep="\t")
 
 
+    def variant_table(self, dtype='variants'):
+        """
+        Returns the parsed variant table (see :py:func:`parse_variants`) for 
+        the rows of the data *dtype*. Tables are cached in the 
+        ``variant_tables`` dictionary, so each variant name is only parsed 
+        once, even if the data are filtered or dumped and restored.
+        """
+        variants = self.df_dict[dtype].index
+        table = self.variant_tables.get(dtype)
+        if table is None:
+            table = parse_variants(variants)
+        else:
+            new = variants[~variants.isin(table['variant'].unique())]
+            if len(new) > 0:
+                table = pd.concat([table, parse_variants(new)], 
+                                  ignore_index=True)
+        self.variant_tables[dtype] = table
+        if len(table['variant'].unique()) > len(variants):
+            table = table[table['variant'].isin(variants)]
+        return table
+
+
     def set_filters(self, config_filters, default_filters):
         """
         Sets the filtering options using the values from the *config_filters* 
@@ -3,6 +3,7 @@ import argparse
 import logging
 import json
 import config_check
+import compression
 from enrich_error import EnrichError
 from experiment import Experiment
 from selection import Selection
@@ -19,6 +20,7 @@ if __name__ == "__main__":
     parser.add_argument("--log", metavar="file", help="path to log file")
     parser.add_argument("--report-filtered-reads", action="store_true", default=False, dest="report_filtered", help="output filtered reads to log file")
     parser.add_argument("--no-plots", help="don't make plots", dest="plots", action="store_false", default=True)
+    parser.add_argument("--decompression", choices=compression.DECOMPRESSION_MODES, default=compression.default_decompression, help="backend for reading compressed FASTQ files (overridden by library config)")
     args = parser.parse_args()
  
     if args.report_filtered:
@@ -33,6 +35,8 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=log_level)
 
+    compression.set_default_decompression(args.decompression)
+
     try:
         config = json.load(open(args.config, "U"))
     except IOError:
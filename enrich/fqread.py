@@ -4,9 +4,14 @@ import os.path
 import re
 import string
 import itertools
-import bz2
-import gzip
+import mmap
+import threading
+from Queue import Queue, Empty
+from multiprocessing import cpu_count
 from array import array
+import numpy as np
+from compression import open_compressed, open_output, is_bgzf
+from index_fastq import FastqIndex
 
 # The following regex is referenced by line number in the class documentation.
 # Matches FASTQ headers based on the following pattern (modify as needed):
@@ -21,25 +26,153 @@ header_pattern = re.compile("@(?P<MachineName>.+)"
                             "/(?P<ReadNumber>\d)")
 
 
+# Matches Casava 1.8+ FASTQ headers based on the following pattern:
+# @<Instrument>:<Run>:<FlowCell>:<Lane>:<Tile>:<X>:<Y> <Read>:<Filtered>:<Control>:<Index>
+casava_header_pattern = re.compile("@(?P<Instrument>[^:\s]+)"
+                                   ":(?P<Run>\d+)"
+                                   ":(?P<FlowCell>[^:\s]+)"
+                                   ":(?P<Lane>\d+)"
+                                   ":(?P<Tile>\d+)"
+                                   ":(?P<X>\d+)"
+                                   ":(?P<Y>\d+)"
+                                   " (?P<ReadNumber>\d)"
+                                   ":(?P<Filtered>[YN])"
+                                   ":(?P<ControlNumber>\d+)"
+                                   ":(?P<Index>\S*)")
+
+
 BUFFER_SIZE = 100000 # empirically optimized for reading FASTQ files
+BATCH_SIZE = 50000   # number of records in each ReadBatch
+PREFETCH_SIZE = 1000 # number of records passed between threads at once
+PREFETCH_CHUNKS = 64 # number of chunks each prefetching thread reads ahead
+WRITE_BUFFER_SIZE = 4194304 # bytes collected by FastqWriter for each write
 
 
 dna_trans = string.maketrans("actgACTG", "tgacTGAC")
+# equivalent lookup table for reverse-complementing arrays of bytes
+dna_complement = np.frombuffer(string.maketrans("actgACTG", "tgacTGAC"), 
+                               dtype=np.uint8)
+
+
+# translation tables for converting between quality strings and Phred scores
+# stored as signed bytes, indexed by qbase
+_quality_tables = dict()
+
+
+def quality_tables(qbase):
+    """
+    Returns a tuple of translation tables for :py:meth:`str.translate`. The 
+    first table decodes an ASCII quality string into a string of signed 
+    bytes containing Phred scores relative to *qbase*. The second table 
+    reverses the process. Tables are only built once for each *qbase*.
+    """
+    try:
+        return _quality_tables[qbase]
+    except KeyError:
+        decode = "".join(chr((i - qbase) % 256) for i in xrange(256))
+        encode = "".join(chr((i + qbase) % 256) for i in xrange(256))
+        _quality_tables[qbase] = (decode, encode)
+        return _quality_tables[qbase]
+
+
+class HeaderFormat(object):
+    """
+    Describes the layout of FASTQ_ headers produced by a particular version 
+    of the Illumina pipeline. The regular expression *pattern* is only used 
+    to recognize the layout (see :py:func:`sniff_header_format`) and by 
+    :py:meth:`FQRead.header_information`. The chastity filter flag is 
+    extracted from each header by the function *flag*, which returns a 
+    one-character string using fixed positions in the header. Reads are 
+    chaste if the flag is equal to *chaste*.
+    """
+    def __init__(self, name, pattern, flag, chaste):
+        self.name = name
+        self.pattern = pattern
+        self.flag = flag
+        self.chaste = chaste
+
+
+    def matches(self, header):
+        """
+        Returns ``True`` if *header* is in this format.
+        """
+        return self.pattern.match(header) is not None
+
+
+    def is_chaste(self, header):
+        """
+        Returns ``True`` if the chastity flag is set in *header*.
+        """
+        return self.flag(header) == self.chaste
+
+
+    def chastity_flags(self, headers):
+        """
+        Returns a boolean array that is ``True`` for each header in the list 
+        *headers* that has the chastity flag set.
+        """
+        if len(headers) == 0:
+            return np.zeros(0, dtype=bool)
+        flags = "".join([self.flag(h) for h in headers])
+        return np.frombuffer(flags, dtype=np.uint8) == ord(self.chaste)
+
+
+def _illumina_flag(header):
+    """
+    Returns the chastity field from a pre-Casava 1.8 header, which is the 
+    first character after the last ``':'``.
+    """
+    return header[header.rfind(":") + 1]
+
+
+def _casava_flag(header):
+    """
+    Returns the filtered field from a Casava 1.8+ header, which follows the 
+    single-digit read number after the space.
+    """
+    return header[header.find(" ") + 3]
+
+
+ILLUMINA_HEADER = HeaderFormat("Illumina", header_pattern, _illumina_flag, "1")
+CASAVA_HEADER = HeaderFormat("Casava 1.8", casava_header_pattern, 
+                             _casava_flag, "N")
+# header formats tried by sniff_header_format, in order
+HEADER_FORMATS = (ILLUMINA_HEADER, CASAVA_HEADER)
+
+
+def sniff_header_format(header):
+    """
+    Returns the :py:class:`HeaderFormat` that matches *header*, or ``None`` 
+    if the format is not recognized. Used to determine the header format 
+    once for each file, based on the first record.
+    """
+    for header_format in HEADER_FORMATS:
+        if header_format.matches(header):
+            return header_format
+    return None
 
 
 class FQRead(object):
     """
     Stores a single record from a FASTQ_ file. Quality values are stored 
-    internally as a list of integer `Phred quality scores \
-    <http://www.phrap.com/phred/#qualityscores>`_. The *qbase* parameter is 
-    the ASCII value that correponds to Phred score of 0. The *sequence* and 
-    *quality* strings must be the same length. 
+    internally as the raw ASCII-encoded quality string, and are only 
+    converted to an :py:class:`array.array` of integer `Phred quality scores \
+    <http://www.phrap.com/phred/#qualityscores>`_ when the :py:attr:`quality` 
+    attribute is accessed. The *qbase* parameter is the ASCII value that 
+    correponds to Phred score of 0. The *sequence* and *quality* strings must 
+    be the same length. 
+
+    The *header_format* is a :py:class:`HeaderFormat` shared by all reads 
+    from the same file. If it is ``None``, the format is determined from 
+    this read's header when it is needed.
     """
     # use slots for memory efficiency
-    __slots__ = ('header', 'sequence', 'header2', 'quality', 'qbase')
+    __slots__ = ('header', 'sequence', 'header2', '_qstring', '_qarray', 
+                 'qbase', 'header_format')
 
 
-    def __init__(self, header, sequence, header2, quality, qbase=33):
+    def __init__(self, header, sequence, header2, quality, qbase=33, 
+                 header_format=None):
         if len(sequence) != len(quality):
             raise ValueError('different lengths for sequence and quality')
         elif header[0] != '@' or header2[0] != '+':
@@ -48,18 +181,46 @@ class FQRead(object):
             self.header = header
             self.sequence = sequence
             self.header2 = header2
-            # quality is a list of integers
-            self.quality = [x - qbase for x in array('b', quality).tolist()]
+            # quality is kept as a string until it is needed
+            self._qstring = quality
+            self._qarray = None
             self.qbase = qbase
+            self.header_format = header_format
+
+
+    @property
+    def quality(self):
+        """
+        Array of integer quality values for the read. The quality string is 
+        decoded the first time this attribute is accessed. The array can be 
+        modified in place, or replaced with any sequence of integers.
+        """
+        if self._qarray is None:
+            decode, _ = quality_tables(self.qbase)
+            self._qarray = array('b', self._qstring.translate(decode))
+            self._qstring = None
+        return self._qarray
+
+
+    @quality.setter
+    def quality(self, values):
+        if not isinstance(values, array):
+            values = array('b', values)
+        self._qarray = values
+        self._qstring = None
 
 
     def __str__(self):
         """
-        Reformat as a four-line FASTQ_ record. This method converts the 
-        integer quality values back into a string.
+        Reformat as a four-line FASTQ_ record. If the quality values have 
+        been decoded, this method converts them back into a string.
         """
-        return '\n'.join([self.header, self.sequence, self.header2, 
-                array('b', [x + self.qbase for x in self.quality]).tostring()])
+        if self._qstring is None:
+            _, encode = quality_tables(self.qbase)
+            quality = self._qarray.tostring().translate(encode)
+        else:
+            quality = self._qstring
+        return '\n'.join([self.header, self.sequence, self.header2, quality])
 
 
     def __len__(self):
@@ -75,7 +236,10 @@ class FQRead(object):
         *start* and *end* (inclusive). Bases are numbered starting at 1.
         """
         self.sequence = self.sequence[start - 1:end]
-        self.quality = self.quality[start - 1:end]
+        if self._qstring is None:
+            self._qarray = self._qarray[start - 1:end]
+        else:
+            self._qstring = self._qstring[start - 1:end]
 
 
     def trim_length(self, length, start=1):
@@ -92,22 +256,34 @@ class FQRead(object):
         quality values.
         """
         self.sequence = self.sequence.translate(dna_trans)[::-1]
-        self.quality = self.quality[::-1]
+        if self._qstring is None:
+            self._qarray = self._qarray[::-1]
+        else:
+            self._qstring = self._qstring[::-1]
 
 
-    def header_information(self, pattern=header_pattern):
-        """header_information(pattern=header_pattern)
+    def header_information(self, pattern=None):
+        """header_information(pattern=None)
 
         Parses the first FASTQ_ header (@ header) and returns a dictionary. 
         Dictionary keys are the named groups in the regular expression 
         *pattern*. Unnamed matches are ignored. Integer values are converted 
         from strings to integers.
 
-        The default pattern matches a header in the format::
+        If *pattern* is ``None``, the pattern for the read's 
+        :py:class:`HeaderFormat` is used. The default pattern matches a 
+        header in the format::
 
             @<MachineName>:<Lane>:<Tile>:<X>:<Y>:<Chastity>#<IndexRead>/<ReadNumber>
 
         """
+        if pattern is None:
+            if self.header_format is None:
+                self.header_format = sniff_header_format(self.header)
+            if self.header_format is None:
+                pattern = header_pattern
+            else:
+                pattern = self.header_format.pattern
         match = pattern.match(self.header)
         if match is None:
             return None
@@ -123,30 +299,346 @@ class FQRead(object):
         """
         Return the minimum Phred-like quality score.
         """
-        return min(self.quality)
+        if self._qstring is None:
+            return min(self._qarray)
+        else:
+            return ord(min(self._qstring)) - self.qbase
 
 
     def mean_quality(self):
         """
         Return the average Phred-like quality score.
         """
-        return float(sum(self.quality)) / len(self)
+        if self._qstring is None:
+            return float(sum(self._qarray)) / len(self)
+        else:
+            return float(sum(bytearray(self._qstring)) - \
+                         self.qbase * len(self)) / len(self)
 
 
     def is_chaste(self):
         """
-        Returns ``True`` if the chastity bit is set in the header. The 
-        regular experession used by :py:meth:`header_information` must  
-        include a ``'Chastity'`` match that equals ``1`` if the read is 
-        chaste.
+        Returns ``True`` if the chastity bit is set in the header (or the 
+        filtered flag is ``N`` for Casava 1.8+ headers). Reads with headers 
+        in an unrecognized format are not chaste (see 
+        :py:class:`HeaderFormat`).
         """
-        try:
-            if self.header_information()['Chastity'] == 1:
-                return True
-            else:
+        if self.header_format is None:
+            self.header_format = sniff_header_format(self.header)
+            if self.header_format is None:
                 return False
-        except KeyError, TypeError: # no 'Chastity' in pattern or no match
-            return False
+        return self.header_format.is_chaste(self.header)
+
+
+
+class ReadBatch(object):
+    """
+    Stores a batch of FASTQ_ records as NumPy arrays. The sequences and 
+    quality values are stored in two-dimensional arrays with one row per 
+    record. Sequences are stored as ASCII values (``uint8``) and quality 
+    values are stored as Phred scores relative to *qbase* (``int8``), 
+    decoded in the same way as :py:attr:`FQRead.quality`.
+
+    If the reads have different lengths, the rows are padded with zeros and 
+    the length of each read is stored in the *lengths* array. The *headers* 
+    and *headers2* lists contain the header lines for each record, which 
+    are all in the same *header_format* (see :py:class:`FQRead`).
+    """
+    def __init__(self, headers, sequences, headers2, qualities, lengths, 
+                 qbase=33, header_format=None):
+        if sequences.shape != qualities.shape:
+            raise ValueError('different shapes for sequence and quality')
+        elif len(headers) != sequences.shape[0] or \
+                len(headers) != len(lengths):
+            raise ValueError('inconsistent number of records in batch')
+        self.headers = headers
+        self.sequences = sequences
+        self.headers2 = headers2
+        self.qualities = qualities
+        self.lengths = lengths
+        self.qbase = qbase
+        self.header_format = header_format
+
+
+    @classmethod
+    def from_records(cls, records, qbase=33, header_format=None):
+        """
+        Creates a new :py:class:`~fqread.ReadBatch` from a list of 
+        *records*, where each record is a list of four strings (header, 
+        sequence, header2, quality).
+        """
+        headers = [r[0] for r in records]
+        headers2 = [r[2] for r in records]
+        sequences = [r[1] for r in records]
+        qualities = [r[3] for r in records]
+        lengths = np.fromiter((len(x) for x in sequences), dtype=np.int32, 
+                              count=len(sequences))
+        if any(len(q) != len(x) for x, q in itertools.izip(sequences, 
+                                                           qualities)):
+            raise ValueError('different lengths for sequence and quality')
+
+        width = lengths.max() if len(records) > 0 else 0
+        seq_buf = np.frombuffer("".join(sequences), dtype=np.uint8)
+        # quality values are signed bytes, as in FQRead
+        qual_buf = (np.frombuffer("".join(qualities), dtype=np.uint8) - 
+                    qbase).view(np.int8)
+        if len(records) > 0 and lengths.min() == width: # fixed length reads
+            seq_matrix = seq_buf.reshape(len(records), width)
+            qual_matrix = qual_buf.reshape(len(records), width)
+        else: # pad the reads with zeros
+            mask = np.arange(width) < lengths[:, np.newaxis]
+            seq_matrix = np.zeros((len(records), width), dtype=np.uint8)
+            seq_matrix[mask] = seq_buf
+            qual_matrix = np.zeros((len(records), width), dtype=np.int8)
+            qual_matrix[mask] = qual_buf
+
+        return cls(headers, seq_matrix, headers2, qual_matrix, lengths, 
+                   qbase=qbase, header_format=header_format)
+
+
+    def __len__(self):
+        """
+        Object length is the number of records in the batch.
+        """
+        return len(self.headers)
+
+
+    def select(self, rows):
+        """
+        Returns a new :py:class:`~fqread.ReadBatch` containing the reads in 
+        *rows*, which is a boolean array or an array of read indices.
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        return ReadBatch([self.headers[i] for i in rows], 
+                         self.sequences[rows], 
+                         [self.headers2[i] for i in rows], 
+                         self.qualities[rows], self.lengths[rows], 
+                         qbase=self.qbase, header_format=self.header_format)
+
+
+    def is_fixed_length(self):
+        """
+        Returns ``True`` if all reads in the batch have the same length and 
+        the arrays contain no padding.
+        """
+        return len(self) == 0 or \
+                (self.lengths == self.sequences.shape[1]).all()
+
+
+    def mask(self):
+        """
+        Returns a boolean array with the same shape as :py:attr:`sequences` 
+        that is ``True`` for positions that contain a base.
+        """
+        return np.arange(self.sequences.shape[1]) < \
+                self.lengths[:, np.newaxis]
+
+
+    def trim(self, start=1, end=None):
+        """
+        Trims all reads in this :py:class:`~fqread.ReadBatch` to contain 
+        bases between *start* and *end* (inclusive). Bases are numbered 
+        starting at 1.
+        """
+        self.sequences = self.sequences[:, start - 1:end]
+        self.qualities = self.qualities[:, start - 1:end]
+        if end is None:
+            end = np.iinfo(self.lengths.dtype).max
+        self.lengths = np.clip(np.minimum(self.lengths, end) - (start - 1), 
+                               0, None).astype(np.int32)
+
+
+    def trim_length(self, length, start=1):
+        """
+        Trims all reads in this :py:class:`~fqread.ReadBatch` to contain 
+        *length* bases, beginning with *start*. Bases are numbered starting 
+        at 1.
+        """
+        self.trim(start=start, end=start + length - 1)
+
+
+    def revcomp(self):
+        """
+        Reverse-complement all sequences in place. Also reverses the quality 
+        values.
+        """
+        if self.is_fixed_length():
+            self.sequences = dna_complement[self.sequences[:, ::-1]]
+            self.qualities = self.qualities[:, ::-1]
+        else:
+            # reverse each row within its own length, leaving the padding
+            index = self.lengths[:, np.newaxis] - 1 - \
+                    np.arange(self.sequences.shape[1])
+            mask = index >= 0
+            index[~mask] = 0
+            rows = np.arange(len(self))[:, np.newaxis]
+            self.sequences = dna_complement[self.sequences[rows, index]]
+            self.sequences[~mask] = 0
+            self.qualities = self.qualities[rows, index]
+            self.qualities[~mask] = 0
+
+
+    def min_quality(self):
+        """
+        Returns an array containing the minimum quality value of each read.
+        """
+        if self.qualities.shape[1] == 0:
+            return np.zeros(len(self), dtype=np.int8)
+        elif self.is_fixed_length():
+            return self.qualities.min(axis=1)
+        else: # padding must not be counted as a low quality value
+            return np.where(self.mask(), self.qualities, 
+                            np.iinfo(np.int8).max).min(axis=1)
+
+
+    def mean_quality(self):
+        """
+        Returns an array containing the average quality value of each read.
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.qualities.sum(axis=1, dtype=np.int64) / \
+                    self.lengths.astype(np.float64)
+
+
+    def is_chaste(self):
+        """
+        Returns a boolean array that is ``True`` for reads that have the 
+        chastity bit set in the header (see :py:meth:`FQRead.is_chaste`). If 
+        the batch has no *header_format*, it is determined from the first 
+        header.
+        """
+        if self.header_format is None and len(self) > 0:
+            self.header_format = sniff_header_format(self.headers[0])
+        if self.header_format is None:
+            return np.zeros(len(self), dtype=bool)
+        return self.header_format.chastity_flags(self.headers)
+
+
+    def sequence(self, i):
+        """
+        Returns the sequence of the *i*\ th read as a string.
+        """
+        return self.sequences[i, :self.lengths[i]].tostring()
+
+
+    def unique_sequences(self, rows=None):
+        """
+        Finds the distinct sequences among the reads in *rows* (a boolean 
+        array or an array of read indices, default all reads). Returns a 
+        tuple containing a sorted list of the distinct sequences as strings, 
+        an array with the number of reads with each sequence, and an array 
+        with the position of each read's sequence in the list.
+        """
+        if rows is None:
+            sequences = self.sequences
+            lengths = self.lengths
+        else:
+            rows = np.asarray(rows)
+            sequences = self.sequences[rows]
+            lengths = self.lengths[rows]
+        if sequences.shape[1] == 0: # only empty reads
+            if len(lengths) == 0:
+                return list(), np.zeros(0, dtype=np.intp), \
+                        np.zeros(0, dtype=np.intp)
+            return [""], np.array([len(lengths)], dtype=np.intp), \
+                    np.zeros(len(lengths), dtype=np.intp)
+        if not (lengths == sequences.shape[1]).all():
+            # padding must be zero so that it is ignored in the keys
+            sequences = np.where(np.arange(sequences.shape[1]) < 
+                                 lengths[:, np.newaxis], sequences, 0)
+        # each row is viewed as a single fixed-width string
+        keys = np.ascontiguousarray(sequences, dtype=np.uint8).view(
+                "S{width}".format(width=sequences.shape[1])).ravel()
+        keys, inverse, counts = np.unique(keys, return_inverse=True, 
+                                          return_counts=True)
+        return keys.tolist(), counts, inverse
+
+
+    def read(self, i):
+        """
+        Returns the *i*\ th read as an :py:class:`~fqread.FQRead`.
+        """
+        quality = (self.qualities[i, :self.lengths[i]] + self.qbase).tostring()
+        return FQRead(self.headers[i], self.sequence(i), self.headers2[i], 
+                      quality, qbase=self.qbase, 
+                      header_format=self.header_format)
+
+
+
+
+class FastqWriter(object):
+    """
+    Writes FASTQ_ records to the file *fname*. Records are collected in 
+    memory and written in blocks of about *buffer_size* bytes. The output 
+    *compression* is ``"gz"``, ``"bgzf"``, ``"bz2"`` or ``None`` (see 
+    :py:func:`~compression.open_output`). If *threaded* is ``True``, 
+    compression runs in a background thread. If *threaded* is ``None``, the 
+    background thread is used for compressed output if more than one CPU 
+    is available.
+
+    :py:class:`~fqread.FastqWriter` objects can be used in a ``with`` 
+    statement, which closes the file at the end of the block.
+    """
+    def __init__(self, fname, compression=None, threaded=None, 
+                 buffer_size=WRITE_BUFFER_SIZE):
+        if threaded is None:
+            threaded = compression is not None and cpu_count() > 1
+        self.handle = open_output(fname, compression, threaded=threaded)
+        self.buffer_size = buffer_size
+        self.pending = list()
+        self.pending_size = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def write(self, fq):
+        """
+        Adds the :py:class:`~fqread.FQRead` *fq* to the output.
+        """
+        record = str(fq)
+        self.pending.append(record)
+        self.pending_size += len(record) + 1
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+
+    def write_batch(self, batch, rows=None):
+        """
+        Adds the reads in the :py:class:`~fqread.ReadBatch` *batch* to the 
+        output. If *rows* is not ``None``, only the reads selected by the 
+        boolean or index array *rows* are written.
+        """
+        if rows is not None:
+            batch = batch.select(rows)
+        for i in xrange(len(batch)):
+            self.write(batch.read(i))
+
+
+    def flush(self):
+        """
+        Writes all collected records to the file.
+        """
+        if len(self.pending) > 0:
+            self.pending.append("") # final newline
+            self.handle.write("\n".join(self.pending))
+            self.pending = list()
+            self.pending_size = 0
+
+
+    def close(self):
+        """
+        Writes all collected records and closes the file.
+        """
+        self.flush()
+        self.handle.close()
 
 
 
@@ -177,64 +669,250 @@ def check_fastq(fname):
 
 
 
-def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE, qbase=33):
+def _mmap_records(fname, buffer_size=BUFFER_SIZE, offset=0):
     """
-    Generator function for reading from FASTQ_ file *fname*. Yields an 
-    :py:class:`~fqread.FQRead` object for each FASTQ_ record in the file. The 
-    *filter_function* must operate on an :py:class:`~fqread.FQRead` object 
-    and return ``True`` or ``False``. If the result is ``False``, the record 
-    will be skipped silently.
+    Generator function for reading from uncompressed FASTQ_ file *fname* 
+    using a memory map, beginning with the record at byte *offset*. Each 
+    block of approximately *buffer_size* bytes is sliced from the mapped 
+    file so that it ends on a record boundary, so no partial records are 
+    copied or joined between blocks. Yields the same lists as 
+    :py:func:`_read_records`.
+    """
+    with open(fname, "rb") as handle:
+        try:
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error): # empty file
+            return
 
-    .. note:: To read multiple files in parallel (such as index or \
-        forward/reverse reads), use :py:func:`read_fastq_multi` instead.
+    try:
+        size = len(data)
+        # handle Windows line endings
+        first = data.find('\n')
+        if first > 0 and data[first - 1] == '\r':
+            newline = '\r\n'
+        else:
+            newline = '\n'
+
+        pos = offset
+        while pos < size:
+            end = min(pos + buffer_size, size)
+            if end < size: # extend the block to the end of the current line
+                end = data.find('\n', end)
+                if end == -1:
+                    end = size
+                else:
+                    end += 1
+            lines = data[pos:end].split(newline)
+            if end == size: # include the final record without a newline
+                fastq_count = len(lines) / 4
+            else:
+                fastq_count = (len(lines) - 1) / 4
+            if fastq_count == 0:
+                if end == size:
+                    break
+                else: # record longer than the block
+                    buffer_size *= 2
+                    continue
+
+            # advance to the end of the last complete record in the block
+            dangling = lines[fastq_count * 4:]
+            pos = end - (sum(len(x) for x in dangling) + \
+                         len(newline) * (len(dangling) - 1))
+
+            for i in xrange(fastq_count):
+                # (header, sequence, header2, quality)
+                yield lines[i * 4:(i + 1) * 4]
+    finally:
+        data.close()
+
+
+
+def _stream_records(fname, compression, buffer_size=BUFFER_SIZE, 
+                    decompression=None, offset=0):
+    """
+    Generator function for reading from FASTQ_ file *fname* in blocks of 
+    *buffer_size* bytes, beginning with the record at *offset*. Yields the 
+    same lists as :py:func:`_read_records`. The file is opened with the 
+    *decompression* backend (see :py:func:`~compression.open_compressed`).
+    """
+    handle = open_compressed(fname, compression, decompression, offset)
+
+    try:
+        eof = False
+        leftover = ''
+
+        while not eof:
+            buf = handle.read(buffer_size)
+            if len(buf) < buffer_size:
+                eof = True
+
+            buf = leftover + buf # prepend partial record from previous buffer
+            lines = buf.split('\n')
+            fastq_count = len(lines) / 4
+
+            if not eof: # handle lines from the trailing partial FASTQ record
+                dangling = len(lines) % 4
+                if dangling == 0: # quality line (probably) incomplete
+                    dangling = 4
+                    fastq_count = fastq_count - 1
+                # join the leftover lines back into a string
+                leftover = '\n'.join(lines[len(lines) - dangling:])
+
+            # index into the list of lines to pull out the FASTQ records
+            for i in xrange(fastq_count):
+                # (header, sequence, header2, quality)
+                yield lines[i * 4:(i + 1) * 4]
+    finally:
+        handle.close()
+
+
+
+def _read_records(fname, buffer_size=BUFFER_SIZE, decompression=None, 
+                  use_mmap=True, start_record=None, end_record=None):
+    """
+    Generator function for reading from FASTQ_ file *fname*. Yields a list 
+    of four strings (header, sequence, header2, quality) for each FASTQ_ 
+    record in the file. Used by :py:func:`read_fastq` and 
+    :py:func:`read_fastq_batches`. Compressed files are opened with the 
+    *decompression* backend (see :py:func:`~compression.open_compressed`). 
+    Uncompressed files are read with :py:func:`_mmap_records` if *use_mmap* 
+    is ``True``.
+
+    Only records numbered from *start_record* up to but not including 
+    *end_record* are returned (records are numbered starting at 0). If the 
+    uncompressed or BGZF_ file has an index (see :py:mod:`~index_fastq`), 
+    reading begins at the closest indexed record. Otherwise, the preceding 
+    records are read and discarded.
     """
     compression = check_fastq(fname)
-    if compression is None: # raw FASTQ
-        handle = open(fname, "rU")
-    elif compression == "bz2":
-        handle = bz2.BZ2File(fname, "rU")
-    elif compression == "gz":
-        handle = gzip.GzipFile(fname, "rU")
+    if start_record is None:
+        start_record = 0
+    skip = start_record
+
+    offset = 0
+    # only uncompressed and BGZF files can be indexed
+    if start_record > 0 and (compression is None or 
+                             (compression == "gz" and is_bgzf(fname))):
+        index = FastqIndex.load(fname)
+        if index is not None:
+            first, offset = index.locate(start_record)
+            skip = start_record - first
+
+    if compression is None and use_mmap:
+        records = _mmap_records(fname, buffer_size=buffer_size, offset=offset)
     else:
-        raise IOError("unrecognized compression mode '{mode}'".format(mode=compression))
+        records = _stream_records(fname, compression, buffer_size=buffer_size,
+                                  decompression=decompression, offset=offset)
 
-    eof = False
-    leftover = ''
+    if end_record is None:
+        stop = None
+    else:
+        stop = max(end_record - start_record, 0) + skip
+    for record in itertools.islice(records, skip, stop):
+        yield record
 
-    while not eof:
-        buf = handle.read(buffer_size)
-        if len(buf) < buffer_size:
-            eof = True
 
-        buf = leftover + buf # prepend partial record from previous buffer
-        lines = buf.split('\n')
-        fastq_count = len(lines) / 4
 
-        if not eof: # handle lines from the trailing partial FASTQ record
-            dangling = len(lines) % 4
-            if dangling == 0: # quality line (probably) incomplete
-                dangling = 4
-                fastq_count = fastq_count - 1
-            # join the leftover lines back into a string
-            leftover = '\n'.join(lines[len(lines) - dangling:])
+def _prefetch(iterable, chunk_size=PREFETCH_SIZE, max_chunks=PREFETCH_CHUNKS):
+    """
+    Generator function that consumes *iterable* in a background thread and 
+    yields the same items. Items are passed between threads in lists of 
+    *chunk_size*, and the thread reads up to *max_chunks* lists ahead of 
+    the caller. Errors in the thread are raised in the caller.
+    """
+    queue = Queue(maxsize=max_chunks)
+    stopped = threading.Event()
 
-        # index into the list of lines to pull out the FASTQ records
-        for i in xrange(fastq_count):
-            # (header, sequence, header2, quality)
-            fq = FQRead(*lines[i * 4:(i + 1) * 4], qbase=qbase)
-            if filter_function is None: # no filtering
-                yield fq
-            elif filter_function(fq):   # passes filtering
-                yield fq
-            else:                       # fails filtering
-                continue
+    def produce():
+        try:
+            chunk = list()
+            for item in iterable:
+                chunk.append(item)
+                if len(chunk) == chunk_size:
+                    queue.put(chunk)
+                    chunk = list()
+                    if stopped.is_set():
+                        break
+            else:
+                if len(chunk) > 0:
+                    queue.put(chunk)
+                queue.put(None)
+        except Exception as err:
+            queue.put(err)
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
 
-    handle.close()
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = queue.get()
+            if chunk is None:
+                break
+            elif isinstance(chunk, Exception):
+                raise chunk
+            for item in chunk:
+                yield item
+    finally:
+        stopped.set()
+        while thread.is_alive(): # unblock the producer if it is waiting
+            try:
+                queue.get_nowait()
+            except Empty:
+                pass
+            thread.join(0.01)
+
+
+
+def read_fastq(fname, filter_function=None, buffer_size=BUFFER_SIZE, qbase=33,
+               decompression=None, start_record=None, end_record=None):
+    """
+    Generator function for reading from FASTQ_ file *fname*. Yields an 
+    :py:class:`~fqread.FQRead` object for each FASTQ_ record in the file. The 
+    *filter_function* must operate on an :py:class:`~fqread.FQRead` object 
+    and return ``True`` or ``False``. If the result is ``False``, the record 
+    will be skipped silently.
+
+    The *decompression* backend for compressed files is passed to 
+    :py:func:`~compression.open_compressed`. Uncompressed files are read 
+    through a memory map.
+
+    To read part of the file, set *start_record* and *end_record* (records 
+    are numbered starting at 0, and *end_record* is not included). Reading 
+    begins part of the way through the file if it has been indexed using 
+    :py:func:`~index_fastq.index_fastq` (compressed files must be in the 
+    BGZF_ format). Use 
+    :py:func:`~index_fastq.shard_fastq` to divide a file between several 
+    workers.
+
+    The header format is determined from the first record (see 
+    :py:func:`sniff_header_format`) and shared by all the reads.
+
+    .. note:: To read multiple files in parallel (such as index or \
+        forward/reverse reads), use :py:func:`read_fastq_multi` instead.
+    """
+    header_format = None
+    for record in _read_records(fname, buffer_size=buffer_size, 
+                                decompression=decompression, 
+                                start_record=start_record, 
+                                end_record=end_record):
+        if header_format is None:
+            header_format = sniff_header_format(record[0])
+        fq = FQRead(*record, qbase=qbase, header_format=header_format)
+        if filter_function is None: # no filtering
+            yield fq
+        elif filter_function(fq):   # passes filtering
+            yield fq
+        else:                       # fails filtering
+            continue
 
 
 
 def read_fastq_multi(fnames, filter_function=None, buffer_size=BUFFER_SIZE,
-                     match_lengths=True, qbase=33):
+                     match_lengths=True, qbase=33, decompression=None, 
+                     start_record=None, end_record=None, prefetch=False):
     """
     Generator function for reading from multiple FASTQ_ files in parallel. 
     The argument *fnames* is an iterable of FASTQ_ file names. Yields a 
@@ -246,11 +924,27 @@ def read_fastq_multi(fnames, filter_function=None, buffer_size=BUFFER_SIZE,
     If *match_lengths* is ``True``, the generator will yield ``None`` if the 
     files do not contain the same number of FASTQ_ records. Otherwise, it 
     will silently ignore partial records.
+
+    The same range of records is read from each file if *start_record* and 
+    *end_record* are set (see :py:func:`read_fastq`).
+
+    If *prefetch* is ``True``, each file is read and decompressed by its own 
+    background thread, which stays up to :py:data:`PREFETCH_CHUNKS` 
+    chunks of :py:data:`PREFETCH_SIZE` records ahead of the caller. 
+    Decompression runs in parallel because :py:mod:`zlib` and 
+    :py:mod:`bz2` release the interpreter lock. To also move decompression 
+    into separate processes, use the ``"external"`` *decompression* 
+    backend. Prefetching is off by default because the threads only help 
+    when reading compressed files on more than one CPU.
     """
     fq_generators = list()
     for f in fnames:
-        fq_generators.append(read_fastq(f, filter_function=None,
-                             buffer_size=BUFFER_SIZE, qbase=qbase))
+        fq = read_fastq(f, filter_function=None, buffer_size=buffer_size, 
+                        qbase=qbase, decompression=decompression, 
+                        start_record=start_record, end_record=end_record)
+        if prefetch:
+            fq = _prefetch(fq)
+        fq_generators.append(fq)
 
     for records in itertools.izip_longest(*fq_generators, fillvalue=None):
         if None in records: # mismatched file lengths
@@ -267,6 +961,71 @@ def read_fastq_multi(fnames, filter_function=None, buffer_size=BUFFER_SIZE,
 
 
 
+def read_fastq_batches(fname, batch_size=BATCH_SIZE, buffer_size=BUFFER_SIZE, 
+                       qbase=33, decompression=None, start_record=None, 
+                       end_record=None):
+    """
+    Generator function for reading from FASTQ_ file *fname* in batches. 
+    Yields a :py:class:`~fqread.ReadBatch` object containing up to 
+    *batch_size* FASTQ_ records. All batches except the last contain 
+    exactly *batch_size* records. The other arguments are the same as 
+    :py:func:`read_fastq`.
+    """
+    header_format = None
+    records = list()
+    for record in _read_records(fname, buffer_size=buffer_size, 
+                                decompression=decompression, 
+                                start_record=start_record, 
+                                end_record=end_record):
+        records.append(record)
+        if len(records) == batch_size:
+            if header_format is None:
+                header_format = sniff_header_format(records[0][0])
+            yield ReadBatch.from_records(records, qbase=qbase, 
+                                         header_format=header_format)
+            records = list()
+    if len(records) > 0:
+        if header_format is None:
+            header_format = sniff_header_format(records[0][0])
+        yield ReadBatch.from_records(records, qbase=qbase, 
+                                     header_format=header_format)
+
+
+
+def read_fastq_multi_batches(fnames, batch_size=BATCH_SIZE, 
+                             buffer_size=BUFFER_SIZE, qbase=33, 
+                             decompression=None, start_record=None, 
+                             end_record=None, prefetch=False):
+    """
+    Generator function for reading from multiple FASTQ_ files in parallel 
+    batches. Yields a tuple of :py:class:`~fqread.ReadBatch` objects, one 
+    for each file in *fnames*, containing the same records (see 
+    :py:func:`read_fastq_multi`). Raises a ``ValueError`` if the files do 
+    not contain the same number of FASTQ_ records. If *prefetch* is 
+    ``True``, each file is read by its own background thread (see 
+    :py:func:`read_fastq_multi`), which builds up to two batches ahead of 
+    the caller. The other arguments are the same as 
+    :py:func:`read_fastq_batches`.
+    """
+    batch_generators = list()
+    for f in fnames:
+        batches = read_fastq_batches(f, batch_size=batch_size, 
+                                     buffer_size=buffer_size, qbase=qbase, 
+                                     decompression=decompression, 
+                                     start_record=start_record, 
+                                     end_record=end_record)
+        if prefetch:
+            batches = _prefetch(batches, chunk_size=1, max_chunks=2)
+        batch_generators.append(batches)
+
+    for batches in itertools.izip_longest(*batch_generators, fillvalue=None):
+        if None in batches or len(set(len(x) for x in batches)) > 1:
+            raise ValueError("FASTQ files do not contain the same number "
+                             "of records")
+        yield batches
+
+
+
 def fastq_filter_chastity(fq):
     """
     Filtering function for :py:func:`read_fastq` and 
@@ -0,0 +1,339 @@
+from __future__ import print_function
+from sys import stderr
+import argparse
+import os.path
+import mmap
+from enrich_error import EnrichError
+from compression import open_compressed, is_bgzf, bgzf_blocks, \
+        decompress_bgzf, BgzfWriter
+
+
+# Number of records between entries in a FASTQ index
+INDEX_INTERVAL = 100000
+
+# File extension for FASTQ index files (appended to the FASTQ file name)
+INDEX_EXTENSION = ".fqi"
+
+# Size of the blocks scanned for line endings while building an index
+SCAN_SIZE = 4194304
+
+# Name used for errors raised by this module
+_INDEX_NAME = "index_fastq.py"
+
+# Leading bytes of compressed files that cannot be indexed
+_GZIP_MAGIC = "\x1f\x8b"
+_BZ2_MAGIC = "BZh"
+
+
+def index_filename(fname):
+    """
+    Returns the name of the sidecar index file for the FASTQ_ file *fname*.
+    """
+    return fname + INDEX_EXTENSION
+
+
+class FastqIndex(object):
+    """
+    Record-aligned index for an uncompressed or BGZF_ compressed FASTQ_ 
+    file. The index stores the byte offset (or virtual offset for BGZF_ 
+    files) of every *interval*\ th record, so that reading can begin part 
+    of the way through the file. Records are numbered starting at
+    0. The total number of *records* and the *size* of the indexed file are
+    stored to detect stale indexes.
+    """
+    def __init__(self, interval, records, size, offsets):
+        self.interval = interval
+        self.records = records
+        self.size = size
+        self.offsets = offsets
+
+
+    def __len__(self):
+        """
+        Object length is the number of records in the indexed file.
+        """
+        return self.records
+
+
+    def locate(self, record):
+        """
+        Returns a tuple containing the number of the closest indexed record
+        at or before *record* and its byte offset.
+        """
+        if record < 0 or record > self.records:
+            raise IndexError("record {n} is outside the indexed file".format(n=record))
+        if len(self.offsets) == 0:
+            if self.records > 0:
+                raise EnrichError("FASTQ index contains no offsets", 
+                                  _INDEX_NAME)
+            return 0, 0 # empty file
+        entry = min(record / self.interval, len(self.offsets) - 1)
+        return entry * self.interval, self.offsets[entry]
+
+
+    def shards(self, count):
+        """
+        Divides the indexed records into at most *count* contiguous shards
+        that begin on indexed records. Returns a list of ``(start, end)``
+        tuples suitable for the *start_record* and *end_record* arguments of
+        :py:func:`~fqread.read_fastq`.
+        """
+        entries = len(self.offsets)
+        count = max(1, min(count, entries))
+        starts = [(entries * i / count) * self.interval for i in xrange(count)]
+        return zip(starts, starts[1:] + [self.records])
+
+
+    def write(self, fname):
+        """
+        Writes the index to the file *fname*.
+        """
+        with open(fname, "w") as handle:
+            print("#fqindex", self.interval, self.records, self.size,
+                  sep="\t", file=handle)
+            for i, offset in enumerate(self.offsets):
+                print(i * self.interval, offset, sep="\t", file=handle)
+
+
+    @classmethod
+    def read(cls, fname):
+        """
+        Reads an index from the file *fname*.
+        """
+        with open(fname, "rU") as handle:
+            try:
+                magic, interval, records, size = \
+                        handle.readline().rstrip("\n").split("\t")
+                if magic != "#fqindex":
+                    raise ValueError
+                offsets = [int(line.split("\t")[1]) for line in handle]
+            except (ValueError, IndexError):
+                raise IOError("invalid FASTQ index file '{fname}'".format(fname=fname))
+        return cls(int(interval), int(records), int(size), offsets)
+
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Returns the sidecar index for the FASTQ_ file *fname*, or ``None`` if
+        there is no index. Raises an ``IOError`` if the index does not match
+        the current file.
+        """
+        if not os.path.isfile(index_filename(fname)):
+            return None
+        index = cls.read(index_filename(fname))
+        if index.size != os.path.getsize(fname):
+            raise IOError("index for '{fname}' is out of date".format(fname=fname))
+        return index
+
+
+def _line_starts(block, lines, next_line, step):
+    """
+    Finds the lines numbered *next_line*, *next_line* + *step*, and so on 
+    that begin inside *block*, where *lines* is the number of lines before 
+    the block. Returns a tuple containing a list of the positions of these 
+    lines in the block, the number of the next line to look for, and the 
+    number of newlines in the block.
+    """
+    positions = list()
+    count = block.count("\n")
+    line, start = lines, 0
+    while next_line <= lines + count:
+        while line < next_line:
+            start = block.find("\n", start) + 1
+            line += 1
+        if start >= len(block): # line begins in the next block
+            break
+        positions.append(start)
+        next_line += step
+    return positions, next_line, count
+
+
+def _mmap_blocks(fname):
+    """
+    Generator function that yields a tuple containing each block of the 
+    uncompressed file *fname* and a function that converts a position in 
+    the block to a file offset.
+    """
+    size = os.path.getsize(fname)
+    if size == 0:
+        return
+    with open(fname, "rb") as handle:
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for pos in xrange(0, size, SCAN_SIZE):
+            yield data[pos:pos + SCAN_SIZE], lambda x, pos=pos: pos + x
+    finally:
+        data.close()
+
+
+def _bgzf_blocks(fname):
+    """
+    Generator function that yields a tuple containing each decompressed 
+    block of the BGZF_ file *fname* and a function that converts a position 
+    in the block to a virtual offset.
+    """
+    for coffset, data in bgzf_blocks(fname):
+        yield decompress_bgzf(data), lambda x, c=coffset: (c << 16) | x
+
+
+def index_fastq(fname, interval=INDEX_INTERVAL, write=True):
+    """
+    Scans the FASTQ_ file *fname* once and builds a :py:class:`FastqIndex` 
+    with an entry every *interval* records. The file must be uncompressed 
+    or compressed in the BGZF_ format (see :py:func:`convert_to_bgzf`). 
+    Raises an :py:class:`~enrich_error.EnrichError` for bzip2 files and 
+    gzip files that are not BGZF_. If 
+    *write* is ``True``, the index is also saved as a sidecar file (see 
+    :py:func:`index_filename`).
+    """
+    with open(fname, "rb") as handle:
+        magic = handle.read(len(_BZ2_MAGIC))
+    if magic.startswith(_BZ2_MAGIC):
+        raise EnrichError("cannot index bzip2 file '{fname}'".format(fname=fname), 
+                          _INDEX_NAME)
+    elif magic.startswith(_GZIP_MAGIC) or \
+            os.path.splitext(fname)[-1].lower() == ".gz":
+        # virtual offsets can only be used to seek in BGZF files
+        if not is_bgzf(fname):
+            raise EnrichError("cannot index gzip file '{fname}' that is not "
+                              "BGZF (use convert_to_bgzf)".format(fname=fname), 
+                              _INDEX_NAME)
+        blocks = _bgzf_blocks(fname)
+    elif os.path.splitext(fname)[-1].lower() == ".bz2":
+        raise EnrichError("cannot index bzip2 file '{fname}'".format(fname=fname), 
+                          _INDEX_NAME)
+    else:
+        blocks = _mmap_blocks(fname)
+
+    offsets = list()
+    lines = 0       # number of newlines before the current block
+    next_line = 0   # line number of the next record to be indexed
+    last = "\n"     # last character in the file
+    for block, to_offset in blocks:
+        positions, next_line, count = _line_starts(block, lines, next_line, 
+                                                   interval * 4)
+        offsets.extend(to_offset(x) for x in positions)
+        lines += count
+        if len(block) > 0:
+            last = block[-1]
+    if last != "\n":
+        lines += 1 # final line has no newline
+
+    records = lines / 4
+    offsets = offsets[:(records + interval - 1) / interval]
+    index = FastqIndex(interval, records, os.path.getsize(fname), offsets)
+    if write:
+        index.write(index_filename(fname))
+    return index
+
+
+def convert_to_bgzf(fname, outname, interval=INDEX_INTERVAL, 
+                    decompression=None):
+    """
+    Rewrites the gzip-compressed FASTQ_ file *fname* as the BGZF_ file 
+    *outname* and writes the index for the new file (see 
+    :py:func:`index_fastq`) in the same pass. The input is read using the 
+    *decompression* backend (see :py:func:`~compression.open_compressed`). 
+    Returns the :py:class:`FastqIndex`.
+    """
+    offsets = list()
+    lines = 0
+    next_line = 0
+    last = "\n"
+    source = open_compressed(fname, "gz", decompression)
+    writer = BgzfWriter(outname)
+    try:
+        while True:
+            chunk = source.read(SCAN_SIZE)
+            if len(chunk) == 0:
+                break
+            positions, next_line, count = _line_starts(chunk, lines, 
+                                                       next_line, interval * 4)
+            # record the virtual offset at the start of each indexed record
+            prev = 0
+            for pos in positions:
+                writer.write(chunk[prev:pos])
+                offsets.append(writer.tell())
+                prev = pos
+            writer.write(chunk[prev:])
+            lines += count
+            last = chunk[-1]
+    finally:
+        source.close()
+        writer.close()
+    if last != "\n":
+        lines += 1
+
+    records = lines / 4
+    offsets = offsets[:(records + interval - 1) / interval]
+    index = FastqIndex(interval, records, os.path.getsize(outname), offsets)
+    index.write(index_filename(outname))
+    return index
+
+
+def shard_fastq(fnames, count, interval=INDEX_INTERVAL):
+    """
+    Divides the records in the uncompressed or BGZF_ FASTQ_ files *fnames* 
+    into at most *count* shards for processing by separate workers. Files without 
+    an up-to-date index are indexed with the given *interval*. All files 
+    must contain the same number of records, as for paired reads read using 
+    :py:func:`~fqread.read_fastq_multi`. Returns a list of 
+    ``(start, end)`` tuples (see :py:meth:`FastqIndex.shards`).
+    """
+    indexes = list()
+    for f in fnames:
+        try:
+            index = FastqIndex.load(f)
+        except IOError: # out of date
+            index = None
+        if index is None:
+            index = index_fastq(f, interval=interval)
+        indexes.append(index)
+
+    if len(set(len(x) for x in indexes)) > 1:
+        raise ValueError("FASTQ files do not contain the same number of records")
+    # shard boundaries must be indexed in every file
+    if len(set(x.interval for x in indexes)) > 1:
+        indexes = [index_fastq(f, interval=interval) for f in fnames]
+    return indexes[0].shards(count)
+
+
+def bgzf_filename(fname, outdir=None):
+    """
+    Returns the name of the BGZF_ file written by the command line tool for 
+    the gzip file *fname* (``reads.fq.gz`` becomes ``reads.bgzf.fq.gz``).
+    """
+    name, ext = os.path.splitext(os.path.basename(fname[:-len(".gz")]))
+    if outdir is None:
+        outdir = os.path.dirname(fname)
+    return os.path.join(outdir, name + ".bgzf" + ext + ".gz")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create record-aligned "
+                                     "indexes for uncompressed or BGZF "
+                                     "FASTQ files.")
+    parser.add_argument("files", metavar="FQ", nargs="+",
+                        help="FASTQ files to index")
+    parser.add_argument("-n", "--interval", metavar="N", type=int,
+                        default=INDEX_INTERVAL,
+                        help="number of records between index entries")
+    parser.add_argument("-c", "--convert", action="store_true", 
+                        default=False, help="convert ordinary gzip files "
+                        "to BGZF before indexing")
+    parser.add_argument("-o", "--output", metavar="DIR",
+                        help="output directory for converted files")
+
+    args = parser.parse_args()
+
+    for f in args.files:
+        if args.convert and f.lower().endswith(".gz") and not is_bgzf(f):
+            outname = bgzf_filename(f, args.output)
+            index = convert_to_bgzf(f, outname, interval=args.interval)
+            print("Converted {n} records in '{fname}' to '{outname}'".format(
+                  n=len(index), fname=f, outname=outname), file=stderr)
+        else:
+            index = index_fastq(f, interval=args.interval)
+            print("Indexed {n} records in '{fname}'".format(n=len(index),
+                  fname=f), file=stderr)
@@ -9,7 +9,6 @@ from seqlib.variant import WILD_TYPE_VARIANT
 from config_check import seqlib_type
 from datacontainer import DataContainer
 import os
-import re
 import math
 import itertools
 import time
@@ -21,21 +20,17 @@ import copy
 
 from sys import stderr
 
-def nonsense_ns_carryover_apply_fn(row, position):
+def nonsense_ns_carryover_fn(variant_table, position):
     """
-    :py:meth:`pandas.DataFrame.apply` function for determining which rows 
-    contribute counts to nonspecific carryover calculations. Returns ``True`` 
-    if the variant has a change to stop at or before amino acid number 
+    Function for determining which variants contribute counts to 
+    nonspecific carryover calculations, using the parsed *variant_table* 
+    (see :py:func:`~datacontainer.parse_variants`). Returns the names of 
+    the variants that have a change to stop at or before amino acid number 
     *position*.
     """
-    m = re.search("p\.[A-Z][a-z][a-z](\d+)Ter", row.name)
-    if m is not None:
-        if int(m.group(1)) <= position:
-            return True
-        else:
-            return False
-    else:
-        return False
+    nonsense = (variant_table['mut_aa'] == "Ter").values & \
+               (variant_table['aa_position'] <= position).values
+    return variant_table['variant'][nonsense].unique()
 
 
 def barcode_variation_apply_fn(row, barcode_data, mapping):
@@ -208,8 +203,8 @@ class Selection(DataContainer):
                                       'max barcode variation' : None})
 
             if 'carryover correction' in config:
-                if config['carrover correction']['method'] == "nonsense":
-                    self.ns_carryover_fn = nonsense_ns_carryover_apply_fn
+                if config['carryover correction']['method'] == "nonsense":
+                    self.ns_carryover_fn = nonsense_ns_carryover_fn
                     self.ns_carryover_kwargs = {'position' : int(config['carryover correction']['position'])}
                 # add additional methods here using "elif" blocks
                 else:
@@ -418,15 +413,17 @@ class Selection(DataContainer):
         self.df_dict['barcodes']['variant'] = self.df_dict['barcodes'].apply(lambda x: self.barcode_map.bc_variant_strings[x.name], axis=1)
 
 
-    def nonspecific_carryover(self, ns_apply_fn, **kwargs):
+    def nonspecific_carryover(self, ns_fn, **kwargs):
         """
         Correct the counts in the 'variants' :py:class:`pandas.DataFrame` for nonspecific carryover. 
-        Nonspecific counts are defined by *ns_apply_fn* and its *kwargs*, which 
-        takes a row as an argument and returns ``True`` if the row's counts 
-        are nonspecific.
+        Nonspecific counts are defined by *ns_fn* and its *kwargs*, which 
+        takes the parsed variant table (see 
+        :py:meth:`~datacontainer.DataContainer.variant_table`) as an argument 
+        and returns the names of the variants whose counts are nonspecific.
         """
         dtype = 'variants'
-        ns_data = self.df_dict[dtype][self.df_dict[dtype].apply(ns_apply_fn, axis=1, **kwargs)]
+        ns_variants = ns_fn(self.variant_table(dtype), **kwargs)
+        ns_data = self.df_dict[dtype][self.df_dict[dtype].index.isin(ns_variants)]
         read_totals = [self.df_dict[dtype]['count.%d' % tp].sum() \
                        for tp in self.timepoints]
         read_totals = dict(zip(self.timepoints, read_totals))
@@ -1,4 +1,6 @@
 from __future__ import print_function
+import multiprocessing
+from collections import OrderedDict
 import numpy as np
 
 # This matrix variable is referenced by line number in the class docstring.
@@ -12,6 +14,8 @@ _simple_similarity = {
         'gap' : -1
 }
 
+# Default k-mer length used by SeedIndex
+SEED_LENGTH = 12
 
 
 class Aligner(object):
@@ -23,7 +27,7 @@ class Aligner(object):
     created. By default, the following matrix is used:
 
     .. literalinclude:: ../seqlib/aligner.py
-        :lines: 5-13
+        :lines: 7-15
 
     The format is a nested dictionary, with a special ``'gap'`` entry for the 
     gap penalty (this value is used for both gap opening and gap extension). 
@@ -34,6 +38,8 @@ class Aligner(object):
     _INS = 2    # insertion (with respect to wild type)
     _DEL = 3    # deletion (with respect to wild type)
     _END = 4    # end of traceback
+    _OUTSIDE = -2 ** 40 # score for cells outside the band
+    _BAND_CHECK = 8     # rows between checks of the banded score
 
     def __init__(self, similarity=_simple_similarity):
         similarity_keys = similarity.keys()
@@ -47,15 +53,201 @@ class Aligner(object):
         self.similarity = similarity
         if 'gap' not in self.similarity:
             raise Exception("No gap penalty")
+        self.gap = self.similarity['gap']
 
-        self.matrix = None
+        # integer encoding of the sequence characters
+        self.alphabet = "".join(sorted(similarity_keys))
+        self.encoding = np.empty(256, dtype=np.intp)
+        self.encoding.fill(-1)
+        for code, base in enumerate(self.alphabet):
+            self.encoding[ord(base)] = code
+        self.lookup = np.array([[similarity[a][b] for b in self.alphabet] 
+                                for a in self.alphabet], dtype=np.int64)
+
+        # score and traceback buffers, reused between calls
+        self.scores = np.zeros((0, 0), dtype=np.int64)
+        self.traces = np.zeros((0, 0), dtype=np.int8)
         self.seq1 = None
         self.seq2 = None
         self.calls = 0
 
 
-    def align(self, seq1, seq2):
+    def encode(self, seq):
+        """
+        Returns an integer array encoding the characters in *seq* as indices 
+        of the similarity lookup matrix.
+        """
+        if isinstance(seq, unicode): # such as sequences loaded from JSON
+            try:
+                seq = seq.encode('ascii')
+            except UnicodeEncodeError:
+                raise KeyError(next(c for c in seq if ord(c) > 127))
+        codes = self.encoding[np.frombuffer(seq, dtype=np.uint8)]
+        if (codes < 0).any():
+            bad = seq[np.flatnonzero(codes < 0)[0]]
+            raise KeyError(bad)
+        return codes
+
+
+    def _buffers(self, rows, cols):
+        """
+        Returns views of the score and traceback buffers with the requested 
+        shape, enlarging the buffers if necessary.
+        """
+        if rows > self.scores.shape[0] or cols > self.scores.shape[1]:
+            shape = (max(rows, self.scores.shape[0]),
+                     max(cols, self.scores.shape[1]))
+            self.scores = np.zeros(shape, dtype=np.int64)
+            self.traces = np.zeros(shape, dtype=np.int8)
+        return self.scores[:rows, :cols], self.traces[:rows, :cols]
+
+
+    def _fill(self, codes1, codes2, free_ends=False):
         """
+        Fills the score and traceback matrices for the global alignment of 
+        the encoded sequences *codes1* and *codes2*. If *free_ends* is 
+        ``True``, insertions before the start of *codes1* are not penalized.
+
+        Each row is calculated from the previous row. The best score for 
+        each cell without a horizontal (insertion) step is known from the 
+        previous row, and the insertion steps are added using a running 
+        maximum along the row.
+        """
+        n = len(codes1)
+        m = len(codes2)
+        score, trace = self._buffers(n + 1, m + 1)
+        gap_cols = self.gap * np.arange(m + 1, dtype=np.int64)
+
+        if free_ends:
+            score[0] = 0
+        else:
+            score[0] = gap_cols
+        trace[0] = Aligner._INS
+        score[:, 0] = self.gap * np.arange(n + 1)
+        trace[:, 0] = Aligner._DEL
+        trace[0, 0] = Aligner._END
+
+        similarity = self.lookup[codes1[:, np.newaxis], codes2]
+        deletions = np.zeros((n + 1, m), dtype=bool)
+        insertions = np.zeros((n + 1, m), dtype=bool)
+        best = np.empty(m + 1, dtype=np.int64)
+        for i in xrange(1, n + 1):
+            prev = score[i - 1]
+            delete = prev[1:] + self.gap
+            best[0] = score[i, 0]
+            np.add(prev[:-1], similarity[i - 1], out=best[1:])
+            np.maximum(best[1:], delete, out=best[1:])
+            # add any number of insertions: best[j] + gap * (k - j)
+            best -= gap_cols
+            row = score[i]
+            np.maximum.accumulate(best, out=row)
+            row += gap_cols
+            np.equal(delete, row[1:], out=deletions[i])
+            np.equal(row[:-1] + self.gap, row[1:], out=insertions[i])
+
+        # traceback with ties resolved as deletion, insertion, match
+        trace[1:, 1:] = np.where(deletions[1:], Aligner._DEL,
+                                 np.where(insertions[1:], Aligner._INS,
+                                          Aligner._MAT))
+
+
+    def _fill_band(self, codes1, codes2, width):
+        """
+        Fills the traceback matrix for the global alignment of the encoded 
+        sequences *codes1* and *codes2*, considering only cells within 
+        *width* diagonals of the main diagonal and the diagonal that ends at 
+        the last cell. The band is stored with one column per diagonal, so 
+        each row only contains the cells inside the band.
+
+        Returns ``True`` if the best alignment must lie inside the band. A 
+        path that leaves the band crosses one of the diagonals next to it,
+        which requires a minimum number of gaps. If the best score such a 
+        path could achieve is lower than the banded score, the banded 
+        traceback is identical to the traceback of the full matrix. 
+        Otherwise returns ``False`` (as soon as the banded score cannot be 
+        high enough), and the full matrix must be filled using 
+        :py:meth:`_fill`.
+        """
+        n = len(codes1)
+        m = len(codes2)
+        lo = min(0, m - n) - width
+        hi = max(0, m - n) + width
+        diagonals = np.arange(lo, hi + 1)
+        gap_diagonals = self.gap * diagonals
+        max_similarity = self.lookup.max()
+
+        # upper bound on the score of any path outside the band
+        outside_bound = None
+        for d in (lo - 1, hi + 1):
+            if -n <= d <= m:
+                gaps = abs(d) + abs(m - n - d)
+                bound = max(max_similarity * (n + m - gaps) / 2.0 + 
+                            self.gap * gaps, self.gap * (n + m))
+                outside_bound = max(bound, outside_bound)
+        # upper bound on the rest of the path from each diagonal is 
+        # remaining[k] + max_similarity * (rows remaining)
+        if outside_bound is not None and max_similarity >= 0 and \
+                2 * self.gap <= max_similarity:
+            remaining = self.gap * np.abs(m - n - diagonals) - \
+                    max_similarity * np.maximum(0, diagonals - (m - n))
+        else:
+            remaining = None
+
+        # column positions and similarity scores of every cell in the band
+        cols = np.arange(n + 1)[:, np.newaxis] + diagonals
+        outside = (cols < 0) | (cols > m)
+        scores = self.lookup[np.r_[0, codes1][:, np.newaxis],
+                             codes2[np.clip(cols - 1, 0, max(m - 1, 0))]] \
+                    if m > 0 else np.zeros(cols.shape, dtype=np.int64)
+        edges = outside.any(axis=1)
+        deletions = np.zeros(cols.shape, dtype=bool)
+        insertions = np.zeros(cols.shape, dtype=bool)
+
+        # first row contains only insertions
+        prev = np.empty(len(diagonals) + 1, dtype=np.int64)
+        prev[:-1] = np.where(outside[0], Aligner._OUTSIDE, gap_diagonals)
+        prev[-1] = Aligner._OUTSIDE # padding for deletions from outside
+        row = prev.copy()
+        best = np.empty(len(diagonals), dtype=np.int64)
+        for i in xrange(1, n + 1):
+            # diagonal steps stay on the same diagonal, deletions move right
+            delete = prev[1:] + self.gap
+            np.add(prev[:-1], scores[i], out=best)
+            np.maximum(best, delete, out=best)
+            best -= gap_diagonals
+            np.maximum.accumulate(best, out=row[:-1])
+            row[:-1] += gap_diagonals
+            if edges[i]:
+                row[:-1][outside[i]] = Aligner._OUTSIDE
+            np.equal(delete, row[:-1], out=deletions[i])
+            np.equal(row[:-2] + self.gap, row[1:-1], out=insertions[i, 1:])
+            prev, row = row, prev
+
+            if remaining is not None and i % Aligner._BAND_CHECK == 0:
+                if (prev[:-1] + remaining).max() + \
+                        max_similarity * (n - i) <= outside_bound:
+                    return False
+
+        if outside_bound is not None and prev[m - n - lo] <= outside_bound:
+            return False
+
+        # traceback with ties resolved as deletion, insertion, match
+        traces = np.where(deletions, Aligner._DEL,
+                          np.where(insertions, Aligner._INS, Aligner._MAT))
+        traces[0] = Aligner._INS
+        traces[0, -lo] = Aligner._END
+
+        # copy the band into the traceback matrix
+        score, trace = self._buffers(n + 1, m + 1)
+        rows = np.arange(n + 1)[:, np.newaxis] + np.zeros_like(diagonals)
+        trace[rows[~outside], cols[~outside]] = traces[~outside]
+        return True
+
+
+    def align(self, seq1, seq2, band=None, max_mutations=None, 
+              semiglobal=False):
+        """align(seq1, seq2, band=None, max_mutations=None, semiglobal=False)
+
         Aligns the two sequences, *seq1* and *seq2* and returns a list of 
         tuples describing the differences between the sequences.
 
@@ -64,49 +256,62 @@ class Aligner(object):
         of ``"match"``, ``"mismatch"``, ``"insertion"``, or ``"deletion"``. 
         For indels, the ``length`` value is the number of bases inserted or 
         deleted with respect to *seq1* starting at ``i``.
+
+        The dynamic programming matrix is filled one row at a time using 
+        array operations. When scores are tied, deletions are preferred to 
+        insertions, and insertions to matches.
+
+        If *band* is not ``None``, the alignment is first calculated using 
+        only the cells within *band* diagonals of the length difference 
+        between the sequences. The full matrix is only filled if the banded 
+        alignment cannot be shown to be the best alignment, so the result is 
+        always the same.
+
+        If *max_mutations* is not ``None``, returns ``None`` if the 
+        alignment contains more than *max_mutations* mismatches and indels.
+
+        If *semiglobal* is ``True``, all of *seq1* is aligned to part of 
+        *seq2*, and the unaligned bases at either end of *seq2* are not 
+        penalized or included in the result. This is used to align reads 
+        with flanking sequence to the wild type. The *band* is not used.
         """
-        self.matrix = np.ndarray(shape=(len(seq1) + 1, len(seq2) + 1), \
-                dtype=np.dtype([('score', np.int), ('trace', np.byte)]))
         seq1 = seq1.upper()
         seq2 = seq2.upper()
-
-        # build matrix of scores/traceback information
-        for i in xrange(len(seq1) + 1):
-            self.matrix[i, 0] = (self.similarity['gap'] * i, Aligner._DEL)
-        for j in xrange(len(seq2) + 1):
-            self.matrix[0, j] = (self.similarity['gap'] * j, Aligner._INS)
-        for i in xrange(1, len(seq1) + 1):
-            for j in xrange(1, len(seq2) + 1):
-                match = (self.matrix[i - 1, j - 1]['score'] + \
-                            self.similarity[seq1[i - 1]][seq2[j - 1]], 
-                            Aligner._MAT)
-                delete = (self.matrix[i - 1, j]['score'] + \
-                            self.similarity['gap'], Aligner._DEL)
-                insert = (self.matrix[i, j - 1]['score'] + \
-                            self.similarity['gap'], Aligner._INS)
-                self.matrix[i, j] = max(delete, insert, match, 
-                                  key=lambda x: x[0])
-        self.matrix[0, 0] = (0, Aligner._END)
+        self.seq1 = seq1
+        self.seq2 = seq2
+        codes1 = self.encode(seq1)
+        codes2 = self.encode(seq2)
+        self.calls += 1
+        if band is not None and 2 * band + abs(len(seq1) - len(seq2)) >= \
+                len(seq2):
+            band = None # band would be wider than the matrix
+        if semiglobal:
+            self._fill(codes1, codes2, free_ends=True)
+        elif band is None or not self._fill_band(codes1, codes2, band):
+            self._fill(codes1, codes2)
+        score, trace = self._buffers(len(seq1) + 1, len(seq2) + 1)
 
         # calculate alignment from the traceback
         i = len(seq1)
         j = len(seq2)
+        if semiglobal: # end at the best cell in the last row
+            j = int(np.argmax(score[i]))
         traceback = list()
-        while i > 0 or j > 0:
-            if self.matrix[i, j]['trace'] == Aligner._MAT:
+        while i > 0 or (j > 0 and not semiglobal):
+            if trace[i, j] == Aligner._MAT:
                 if seq1[i - 1] == seq2[j - 1]:
                     traceback.append((i - 1, j - 1, "match", None))
                 else:
                     traceback.append((i - 1, j - 1, "mismatch", None))
                 i -= 1
                 j -= 1
-            elif self.matrix[i, j]['trace'] == Aligner._INS:
+            elif trace[i, j] == Aligner._INS:
                 traceback.append((i - 1, j - 1, "insertion", 1))
                 j -= 1
-            elif self.matrix[i, j]['trace'] == Aligner._DEL:
+            elif trace[i, j] == Aligner._DEL:
                 traceback.append((i - 1, j - 1, "deletion", 1))
                 i -= 1
-            elif self.matrix[i, j]['trace'] == Aligner._END:
+            elif trace[i, j] == Aligner._END:
                 pass
             else:
                 raise Exception("Serious alignment error")
@@ -132,5 +337,232 @@ class Aligner(object):
         if indel is not None:
             traceback_combined.append(tuple(indel))
 
-        self.calls += 1
+        if max_mutations is not None:
+            if sum(1 for t in traceback_combined if t[2] != "match") > \
+                    max_mutations:
+                return None
         return traceback_combined
+
+
+# Aligner used by each worker process in align_parallel
+_pool_aligner = None
+
+
+def _init_pool(similarity):
+    """
+    Initializer for the worker processes used by :py:func:`align_parallel`.
+    """
+    global _pool_aligner
+    _pool_aligner = Aligner(similarity)
+
+
+def _pool_align(args):
+    """
+    Aligns a single pair of sequences in a worker process. *args* is a tuple 
+    of arguments for :py:meth:`Aligner.align`.
+    """
+    seq1, seq2, band, max_mutations = args
+    return _pool_aligner.align(seq1, seq2, band=band, 
+                               max_mutations=max_mutations)
+
+
+def align_pool(aligner, processes):
+    """
+    Returns a pool of *processes* worker processes for 
+    :py:func:`align_parallel`, each with a copy of the similarity matrix 
+    used by *aligner*. The caller should close the pool when it is no 
+    longer needed.
+    """
+    return multiprocessing.Pool(processes, initializer=_init_pool, 
+                                initargs=(aligner.similarity,))
+
+
+def align_parallel(aligner, jobs, processes, pool=None):
+    """
+    Performs the alignments described by *jobs* using a pool of *processes* 
+    worker processes, each with a copy of the similarity matrix used by 
+    *aligner*. Each job is a tuple of the *seq1*, *seq2*, *band*, and 
+    *max_mutations* arguments for :py:meth:`Aligner.align`. Returns a list 
+    of the results in the same order as *jobs*, and adds the number of 
+    alignments to ``aligner.calls``.
+
+    If *pool* is ``None``, a new pool is created (see :py:func:`align_pool`) 
+    and closed when the alignments are finished. Otherwise, the existing 
+    *pool* is used, so that it can be shared by many calls.
+    """
+    jobs = list(jobs)
+    if len(jobs) == 0:
+        return list()
+    chunk_size = max(1, len(jobs) / (processes * 4))
+    if pool is not None:
+        results = pool.map(_pool_align, jobs, chunk_size)
+    else:
+        pool = align_pool(aligner, processes)
+        try:
+            results = pool.map(_pool_align, jobs, chunk_size)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    aligner.calls += len(jobs)
+    return results
+
+
+class SeedIndex(object):
+    """
+    Index of the positions of every k-mer of length *k* in the *reference* 
+    sequence. The index is used to find the part of a longer read that 
+    corresponds to the reference, so that reads with flanking sequence can 
+    be aligned using a small window of the read.
+    """
+    def __init__(self, reference, k=SEED_LENGTH):
+        self.reference = reference.upper()
+        self.k = k
+        self.positions = dict()
+        for i in xrange(len(self.reference) - k + 1):
+            self.positions.setdefault(self.reference[i:i + k], list()).append(i)
+
+
+    def diagonals(self, seq):
+        """
+        Returns a dictionary containing the number of k-mers of *seq* that 
+        match the reference on each diagonal. The diagonal is the position 
+        of the k-mer in *seq* minus its position in the reference, so a 
+        diagonal of ``d`` means the reference starts at position ``d`` of 
+        *seq*.
+        """
+        counts = dict()
+        k = self.k
+        positions = self.positions
+        for i in xrange(len(seq) - k + 1):
+            hits = positions.get(seq[i:i + k])
+            if hits is not None:
+                for j in hits:
+                    counts[i - j] = counts.get(i - j, 0) + 1
+        return counts
+
+
+class EditDistance(object):
+    """
+    Class for calculating the edit distance between a fixed *reference* 
+    sequence and other sequences using the bit-parallel algorithm of 
+    `Myers (1999) <http://dx.doi.org/10.1145/316542.316550>`_, with the 
+    global alignment boundary described by Hyyro. Each column of the 
+    dynamic programming matrix is updated using a handful of operations on 
+    integers with one bit per reference position.
+
+    Every substitution, inserted base, and deleted base counts as one edit. 
+    ``'N'`` and ``'X'`` characters do not match anything.
+    """
+    def __init__(self, reference):
+        self.reference = reference.upper()
+        self.mask = (1 << len(self.reference)) - 1
+        self.high = 1 << (len(self.reference) - 1)
+
+        # bit vectors of the positions of each base in the reference
+        self.peq = dict()
+        for i, base in enumerate(self.reference):
+            self.peq[base] = self.peq.get(base, 0) | (1 << i)
+
+
+    def distance(self, seq, limit=None):
+        """distance(seq, limit=None)
+
+        Returns the edit distance between the reference and *seq*. If 
+        *limit* is not ``None``, returns ``limit + 1`` as soon as the 
+        distance must be greater than *limit*.
+        """
+        n = len(self.reference)
+        m = len(seq)
+        if limit is not None and abs(n - m) > limit:
+            return limit + 1
+        if n == 0:
+            return m
+
+        mask = self.mask
+        high = self.high
+        peq = self.peq
+        pv = mask
+        mv = 0
+        score = n
+        for j, c in enumerate(seq.upper()):
+            eq = peq.get(c, 0)
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & high:
+                score += 1
+            elif mh & high:
+                score -= 1
+            # the top row of the matrix increases by one in each column
+            ph = ((ph << 1) | 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            # the score can decrease by at most one per remaining column
+            if limit is not None and score - (m - j - 1) > limit:
+                return limit + 1
+        return score
+
+
+class AlignmentCache(object):
+    """
+    Dictionary-like cache of alignment results with a limit of *max_entries* 
+    entries (no limit if ``None``). When the cache is full, the least 
+    recently used entry is discarded. Looking up a key with ``[]`` updates 
+    the ``hits`` or ``misses`` count, and discarded entries are counted in 
+    ``evictions``. Membership tests do not affect the counts.
+    """
+    def __init__(self, max_entries=None):
+        if max_entries is not None and max_entries < 1:
+            raise ValueError("alignment cache must hold at least one entry")
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+    def __getitem__(self, key):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.entries[key] = value # most recently used
+        self.hits += 1
+        return value
+
+
+    def __setitem__(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if self.max_entries is not None:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def stats(self):
+        """
+        Returns a string describing the cache hits, misses, and evictions 
+        for log messages.
+        """
+        return "{hits} hits, {misses} misses, {evictions} " \
+               "evictions".format(hits=self.hits, misses=self.misses, 
+                                  evictions=self.evictions)
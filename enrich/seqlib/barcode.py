@@ -3,7 +3,8 @@ import re
 import logging
 from seqlib import SeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq, check_fastq
+from fqread import read_fastq_batches, check_fastq
+import numpy as np
 import pandas as pd
 
 # debugging
@@ -95,42 +96,25 @@ class BarcodeSeqLib(SeqLib):
         """
         self.df_dict['barcodes'] = dict()
 
-        filter_flags = dict()
-        for key in self.filters:
-            filter_flags[key] = False
-
         # count all the barcodes
         logging.info("Counting barcodes [{name}]".format(name=self.name))
-        for fq in read_fastq(self.reads):
-            fq.trim_length(self.bc_length, start=self.bc_start)
+        for batch in read_fastq_batches(self.reads, 
+                                        decompression=self.decompression):
+            batch.trim_length(self.bc_length, start=self.bc_start)
             if self.revcomp_reads:
-                fq.revcomp()
-
-            for key in filter_flags:
-                filter_flags[key] = False
-
-            # filter the barcode based on specified quality settings
-            if self.filters['chastity']:
-                if not fq.is_chaste():
-                    self.filter_stats['chastity'] += 1
-                    filter_flags['chastity'] = True
-            if self.filters['min quality'] > 0:
-                if fq.min_quality() < self.filters['min quality']:
-                    self.filter_stats['min quality'] += 1
-                    filter_flags['min quality'] = True
-            if self.filters['avg quality'] > 0:
-                if fq.mean_quality() < self.filters['avg quality']:
-                    self.filter_stats['avg quality'] += 1
-                    filter_flags['avg quality'] = True
-            if any(filter_flags.values()): # failed quality filtering
-                self.filter_stats['total'] += 1
-                if self.report_filtered:
-                    self.report_filtered_read(fq, filter_flags)
-            else: # passed quality filtering
+                batch.revcomp()
+
+            # filter the barcodes based on specified quality settings
+            masks, failed = self.filter_batch(batch)
+            self.filter_stats['total'] += int(failed.sum())
+            if self.report_filtered:
+                self.report_filtered_batch(batch, masks, failed)
+            for i in np.flatnonzero(~failed): # passed quality filtering
+                barcode = batch.sequence(i).upper()
                 try:
-                    self.df_dict['barcodes'][fq.sequence.upper()] += 1
+                    self.df_dict['barcodes'][barcode] += 1
                 except KeyError:
-                    self.df_dict['barcodes'][fq.sequence.upper()] = 1
+                    self.df_dict['barcodes'][barcode] = 1
 
         self.df_dict['barcodes'] = \
                 pd.DataFrame.from_dict(self.df_dict['barcodes'], 
@@ -100,7 +100,8 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
             self.set_filters(config['filters'], {'min quality' : 0,
                                       'avg quality' : 0,
                                       'chastity' : False,
-                                      'max mutations' : len(self.wt_dna)})
+                                      'max mutations' : len(self.wt_dna),
+                                      'edit prescreen' : False})
         except KeyError as key:
             raise EnrichError("Missing required config value {key}".format(key=key), 
                               self.name)
@@ -133,24 +134,32 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
             self.dump_data(keys=['barcodes_unmapped']) # save memory
 
         # count variants associated with the barcodes
+        self.align_variants(self.barcode_map[bc] 
+                            for bc in self.df_dict['barcodes'].index)
         for bc, count in self.df_dict['barcodes'].iterrows():
             count = count['count']
             variant = self.barcode_map[bc]
             mutations = self.count_variant(variant, copies=count)
-            if mutations is None: # variant has too many mutations
-                self.filter_stats['max mutations'] += count
+            if mutations is None or mutations is False:
+                if mutations is None: # variant has too many mutations
+                    key = 'max mutations'
+                else: # variant failed the edit distance prescreen
+                    key = 'edit prescreen'
+                self.filter_stats[key] += count
                 self.filter_stats['total'] += count
                 if self.report_filtered:
-                    self.report_filtered_variant(variant, count)
+                    self.report_filtered_variant(variant, count, key)
                 if bc not in self.barcode_map.bc_variant_strings:
                     self.barcode_map.bc_variant_strings[bc] = FILTERED_VARIANT
             else:
+                mutations = self.variant_string(mutations)
                 if mutations not in self.barcode_map.variants:
                     self.barcode_map.variants[mutations] = set()
                 self.barcode_map.variants[mutations].update([bc])
                 self.barcode_map.bc_variant_strings[bc] = mutations
 
 
+        self.format_variants()
         self.df_dict['variants'] = \
                 pd.DataFrame.from_dict(self.df_dict['variants'], 
                                        orient="index", dtype="int32")
@@ -163,16 +172,18 @@ class BarcodeVariantSeqLib(VariantSeqLib, BarcodeSeqLib):
                 n=self.df_dict['variants']['count'].sum(), u=len(self.df_dict['variants'].index), name=self.name))
         if self.aligner is not None:
             logging.info("Aligned {n} variants [{name}]".format(n=self.aligner.calls, name=self.name))
-            self.aligner_cache = None
+            self.close_alignment_cache()
+            self.close_align_pool()
         self.report_filter_stats()
 
 
-    def report_filtered_variant(self, variant, count):
+    def report_filtered_variant(self, variant, count, key='max mutations'):
         """
-        Outputs a summary of the filtered variant to *handle*. Internal filter 
-        names are converted to messages using the ``DataContainer._filter_messages`` 
-        dictionary. Related to :py:meth:`SeqLib.report_filtered`.
+        Outputs a summary of the filtered variant to *handle*. The internal 
+        filter name *key* is converted to a message using the 
+        ``DataContainer._filter_messages`` dictionary. Related to 
+        :py:meth:`SeqLib.report_filtered`.
         """
         logging.debug("Filtered variant (quantity={n}) ({messages}) [{name}]\n{read!s}".format(
-                    n=count, messages=DataContainer._filter_messages['max mutations'], name=self.name, read=variant), file=handle)
+                    n=count, messages=DataContainer._filter_messages[key], name=self.name, read=variant), file=handle)
 
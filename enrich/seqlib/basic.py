@@ -1,6 +1,6 @@
 from variant import VariantSeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq, check_fastq
+from fqread import read_fastq_batches, check_fastq
 import pandas as pd
 import logging
 
@@ -28,7 +28,8 @@ class BasicSeqLib(VariantSeqLib):
             self.set_filters(config['filters'], {'min quality' : 0,
                                       'avg quality' : 0,
                                       'chastity' : False,
-                                      'max mutations' : len(self.wt_dna)})
+                                      'max mutations' : len(self.wt_dna),
+                                      'edit prescreen' : False})
         except KeyError as key:
             raise EnrichError("missing required config value: {key}".format(key=key), self.name)
 
@@ -41,45 +42,31 @@ class BasicSeqLib(VariantSeqLib):
     def calculate(self):
         """
         Reads the forward or reverse FASTQ file (reverse reads are reverse-complemented),
-        performs quality-based filtering, and counts the variants.
+        performs quality-based filtering, and counts the variants. Identical 
+        sequences in each batch of reads are counted together.
         """
         self.df_dict['variants'] = dict()
 
-        filter_flags = dict()
-        for key in self.filters:
-            filter_flags[key] = False
-
         logging.info("Counting variants [{name}]".format(name=self.name))
-        for fq in read_fastq(self.reads):
+        for batch in read_fastq_batches(self.reads, 
+                                        decompression=self.decompression):
             if self.revcomp_reads:
-                fq.revcomp()
-
-            for key in filter_flags:
-                filter_flags[key] = False
+                batch.revcomp()
 
-            # filter the read based on specified quality settings
-            if self.filters['chastity']:
-                if not fq.is_chaste():
-                    self.filter_stats['chastity'] += 1
-                    filter_flags['chastity'] = True
-            if self.filters['min quality'] > 0:
-                if fq.min_quality() < self.filters['min quality']:
-                    self.filter_stats['min quality'] += 1
-                    filter_flags['min quality'] = True
-            if self.filters['avg quality'] > 0:
-                if fq.mean_quality() < self.filters['avg quality']:
-                    self.filter_stats['avg quality'] += 1
-                    filter_flags['avg quality'] = True
-            if not any(filter_flags.values()): # passed quality filtering
-                mutations = self.count_variant(fq.sequence)
-                if mutations is None: # read has too many mutations
-                    self.filter_stats['max mutations'] += 1
-                    filter_flags['max mutations'] = True
-            if any(filter_flags.values()):
-                self.filter_stats['total'] += 1
-                if self.report_filtered:
-                    self.report_filtered_read(fq, filter_flags)
+            # filter the reads based on specified quality settings
+            masks, failed = self.filter_batch(batch)
+            # count the reads that passed quality filtering
+            excess, prescreened = self.count_batch(batch, ~failed)
+            self.filter_stats['max mutations'] += int(excess.sum())
+            self.filter_stats['edit prescreen'] += int(prescreened.sum())
+            masks['max mutations'] = excess
+            masks['edit prescreen'] = prescreened
+            failed |= excess | prescreened
+            self.filter_stats['total'] += int(failed.sum())
+            if self.report_filtered:
+                self.report_filtered_batch(batch, masks, failed)
 
+        self.format_variants()
         self.df_dict['variants'] = \
                 pd.DataFrame.from_dict(self.df_dict['variants'], 
                                        orient="index", dtype="int32")
@@ -92,5 +79,6 @@ class BasicSeqLib(VariantSeqLib):
                 n=self.df_dict['variants']['count'].sum(), u=len(self.df_dict['variants'].index), name=self.name))
         if self.aligner is not None:
             logging.info("Aligned {n} variants [{name}]".format(n=self.aligner.calls, name=self.name))
-            self.aligner_cache = None
+            self.close_alignment_cache()
+            self.close_align_pool()
         self.report_filter_stats()
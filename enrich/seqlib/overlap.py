@@ -2,7 +2,8 @@ from __future__ import print_function
 from sys import stderr
 from variant import VariantSeqLib
 from enrich_error import EnrichError
-from fqread import read_fastq_multi, check_fastq, FQRead
+from fqread import read_fastq_multi_batches, check_fastq, FQRead, ReadBatch
+import numpy as np
 import pandas as pd
 import logging
 
@@ -67,6 +68,7 @@ class OverlapSeqLib(VariantSeqLib):
                                       'min quality' : 0,
                                       'avg quality' : 0,
                                       'max mutations' : len(self.wt_dna),
+                                      'edit prescreen' : False,
                                       'chastity' : False,
                                       'merge failure' : True})
         except KeyError as key:
@@ -101,7 +103,8 @@ class OverlapSeqLib(VariantSeqLib):
                        sequence="A",
                        header2=fwd.header2,
                        quality="#",
-                       qbase=fwd.qbase)
+                       qbase=fwd.qbase,
+                       header_format=fwd.header_format)
         merge.sequence = list(fwd.sequence[:fwd_end] + \
                                      rev.sequence[rev_extra_start:])
         merge.quality = fwd.quality[:fwd_end] + \
@@ -133,67 +136,136 @@ class OverlapSeqLib(VariantSeqLib):
         return merge
 
 
+    def merge_batch(self, fwd, rev):
+        """
+        Combines the reads in the *fwd* and *rev* 
+        :py:class:`~fqread.ReadBatch` objects in the same way as 
+        :py:meth:`merge_reads`. The *rev* batch is reverse-complemented in 
+        place. Returns a tuple containing a :py:class:`~fqread.ReadBatch` of 
+        merged reads and a boolean array that is ``True`` for reads that 
+        could not be merged (the corresponding merged reads are empty).
+
+        Batches of fixed-length reads are merged using array operations. 
+        Otherwise, each pair of reads is merged using :py:meth:`merge_reads`.
+        """
+        fwd_end = self.fwd_start + self.overlap_length - 1
+        if len(fwd) > 0 and fwd.is_fixed_length() and rev.is_fixed_length():
+            rev_len = rev.sequences.shape[1]
+            rev_extra_start = rev_len - self.rev_start + 1
+            a = self.fwd_start - 1
+            b = rev_extra_start - self.overlap_length
+            vectorized = a >= 0 and b >= 0 and self.rev_start >= 1 and \
+                    fwd_end <= fwd.sequences.shape[1]
+        else:
+            vectorized = False
+
+        if not vectorized:
+            merges = [self.merge_reads(fwd.read(i), rev.read(i)) 
+                      for i in xrange(len(fwd))]
+            rev.revcomp()
+            failed = np.array([m is None for m in merges], dtype=bool)
+            records = list()
+            for i, m in enumerate(merges):
+                if m is None:
+                    records.append([fwd.headers[i], "", fwd.headers2[i], ""])
+                else:
+                    records.append(str(m).split("\n"))
+            return ReadBatch.from_records(records, qbase=fwd.qbase, 
+                    header_format=fwd.header_format), failed
+
+        rev.revcomp()
+        sequences = np.hstack([fwd.sequences[:, :fwd_end], 
+                               rev.sequences[:, rev_extra_start:]])
+        qualities = np.hstack([fwd.qualities[:, :fwd_end], 
+                               rev.qualities[:, rev_extra_start:]])
+
+        # compare the overlapping region
+        fwd_seq = fwd.sequences[:, a:fwd_end]
+        rev_seq = rev.sequences[:, b:rev_extra_start]
+        fwd_qual = fwd.qualities[:, a:fwd_end]
+        rev_qual = rev.qualities[:, b:rev_extra_start]
+        mismatch = fwd_seq != rev_seq
+        # take the highest quality base, or 'X' if the mismatch is unresolvable
+        overlap = np.where(rev_qual > fwd_qual, rev_seq, fwd_seq)
+        overlap[mismatch & (rev_qual == fwd_qual)] = ord('X')
+        sequences[:, a:fwd_end] = overlap
+        qualities[:, a:fwd_end] = np.maximum(fwd_qual, rev_qual)
+        failed = mismatch.sum(axis=1) > self.max_overlap_mismatches
+
+        lengths = np.empty(len(fwd), dtype=np.int32)
+        lengths.fill(sequences.shape[1])
+        lengths[failed] = 0
+        sequences[failed] = 0
+        qualities[failed] = 0
+        merged = ReadBatch(fwd.headers, sequences, fwd.headers2, qualities, 
+                           lengths, qbase=fwd.qbase, 
+                           header_format=fwd.header_format)
+        if self.trim:
+            merged.trim_length(self.overlap_length, self.fwd_start)
+        return merged, failed
+
+
     def calculate(self):
         """
         Reads the forward and reverse reads, merges them, performs 
-        quality-based filtering, and counts the variants.
+        quality-based filtering, and counts the variants. Identical merged 
+        sequences in each batch of reads are counted together.
         """
         self.df_dict['variants'] = dict()
 
-        filter_flags = dict()
-        for key in self.filters:
-            filter_flags[key] = False
-
         logging.info("Counting variants [{name}]".format(name=self.name))
-        for fwd, rev in read_fastq_multi([self.forward, self.reverse]):
-            for key in filter_flags:
-                filter_flags[key] = False
-
-            # filter the read based on specified quality settings
+        for fwd, rev in read_fastq_multi_batches([self.forward, self.reverse],
+                                        decompression=self.decompression):
+            # filter the read pairs based on chastity
+            unchaste = np.zeros(len(fwd), dtype=bool)
             if self.filters['chastity']:
-                if not fwd.is_chaste():
-                    filter_flags['chastity'] = True
-                    if self.report_filtered:
-                        self.report_filtered_read(fwd, filter_flags)
-                if not rev.is_chaste():
-                    filter_flags['chastity'] = True
-                    if self.report_filtered:
-                        self.report_filtered_read(rev, filter_flags)
-                if filter_flags['chastity']:
-                    self.filter_stats['chastity'] += 1
-                    self.filter_stats['total'] += 1
-                    continue
-            merge = self.merge_reads(fwd, rev)
-            if merge is None: # merge failed
-                self.filter_stats['merge failure'] += 1
-                self.filter_stats['total'] += 1
-                filter_flags['merge failure'] = True
+                fwd_chaste = fwd.is_chaste()
+                rev_chaste = rev.is_chaste()
+                unchaste = ~(fwd_chaste & rev_chaste)
+                self.filter_stats['chastity'] += int(unchaste.sum())
+                self.filter_stats['total'] += int(unchaste.sum())
                 if self.report_filtered:
-                    self.report_filtered_read(fwd, filter_flags)
-                    self.report_filtered_read(rev, filter_flags)
-            else:
-                if self.filters['remove unresolvable']:
-                    if 'X' in merge.sequence:
-                        self.filter_stats['remove unresolvable'] += 1
-                        filter_flags['remove unresolvable'] = True
-                if self.filters['min quality'] > 0:
-                    if merge.min_quality() < self.filters['min quality']:
-                        self.filter_stats['min quality'] += 1
-                        filter_flags['min quality'] = True
-                if self.filters['avg quality'] > 0:
-                    if merge.mean_quality() < self.filters['avg quality']:
-                        self.filter_stats['avg quality'] += 1
-                        filter_flags['avg quality'] = True
-                if not any(filter_flags.values()): # passed quality filtering
-                    mutations = self.count_variant(merge.sequence)
-                    if mutations is None: # merge read has too many mutations
-                        self.filter_stats['max mutations'] += 1
-                        filter_flags['max mutations'] = True
-                if any(filter_flags.values()):
-                    self.filter_stats['total'] += 1
-                    if self.report_filtered:
-                        self.report_filtered_read(merge, filter_flags)
+                    for i in np.flatnonzero(unchaste):
+                        if not fwd_chaste[i]:
+                            self.report_filtered_read(fwd.read(i), 
+                                                      {'chastity' : True})
+                        if not rev_chaste[i]:
+                            self.report_filtered_read(rev.read(i), 
+                                                      {'chastity' : True})
+
+            merged, merge_failed = self.merge_batch(fwd, rev)
+            merge_failed &= ~unchaste
+            self.filter_stats['merge failure'] += int(merge_failed.sum())
+            self.filter_stats['total'] += int(merge_failed.sum())
+            if self.report_filtered:
+                for i in np.flatnonzero(merge_failed):
+                    self.report_filtered_read(fwd.read(i), 
+                                              {'merge failure' : True})
+                    self.report_filtered_read(rev.read(i), 
+                                              {'merge failure' : True})
+
+            # filter the merged reads based on specified quality settings
+            merged = merged.select(~(unchaste | merge_failed))
+            masks, failed = self.filter_batch(merged, 
+                    filters=('min quality', 'avg quality'))
+            if self.filters['remove unresolvable']:
+                unresolvable = (merged.sequences == ord('X')).any(axis=1)
+                self.filter_stats['remove unresolvable'] += \
+                        int(unresolvable.sum())
+                masks['remove unresolvable'] = unresolvable
+                failed |= unresolvable
+            # count the merged reads that passed quality filtering
+            excess, prescreened = self.count_batch(merged, ~failed)
+            self.filter_stats['max mutations'] += int(excess.sum())
+            self.filter_stats['edit prescreen'] += int(prescreened.sum())
+            masks['max mutations'] = excess
+            masks['edit prescreen'] = prescreened
+            failed |= excess | prescreened
+            self.filter_stats['total'] += int(failed.sum())
+            if self.report_filtered:
+                self.report_filtered_batch(merged, masks, failed)
 
+        self.format_variants()
         self.df_dict['variants'] = \
                 pd.DataFrame.from_dict(self.df_dict['variants'], 
                                        orient="index", dtype="int32")
@@ -206,6 +278,7 @@ class OverlapSeqLib(VariantSeqLib):
                 n=self.df_dict['variants']['count'].sum(), u=len(self.df_dict['variants'].index), name=self.name))
         if self.aligner is not None:
             logging.info("Aligned {n} variants [{name}]".format(n=self.aligner.calls, name=self.name))
-            self.aligner_cache = None
+            self.close_alignment_cache()
+            self.close_align_pool()
         self.report_filter_stats()
 
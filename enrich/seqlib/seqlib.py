@@ -3,7 +3,13 @@ import time
 import logging
 from enrich_error import EnrichError
 from datacontainer import DataContainer
+from compression import DECOMPRESSION_MODES
 import os.path
+import numpy as np
+
+
+# Filters that can be applied to a ReadBatch by SeqLib.filter_batch
+BATCH_FILTERS = ('chastity', 'min quality', 'avg quality')
 
 
 class SeqLib(DataContainer):
@@ -31,6 +37,13 @@ class SeqLib(DataContainer):
         else:
             self.report_filtered = False
 
+        self.decompression = None
+        if 'fastq' in config:
+            if 'decompression' in config['fastq']:
+                self.decompression = config['fastq']['decompression']
+                if self.decompression not in DECOMPRESSION_MODES:
+                    raise EnrichError("Invalid decompression mode '{mode}'".format(mode=self.decompression), self.name)
+
 
     def calculate(self):
         """
@@ -53,6 +66,51 @@ class SeqLib(DataContainer):
                       name=self.name, read=fq))
 
 
+    def filter_batch(self, batch, filters=BATCH_FILTERS):
+        """filter_batch(batch, filters=BATCH_FILTERS)
+
+        Applies the read-level *filters* (any of ``'chastity'``, 
+        ``'min quality'`` and ``'avg quality'``) to every read in the 
+        :py:class:`~fqread.ReadBatch` *batch*, adding the number of reads 
+        that fail each filter to ``filter_stats``. The ``'total'`` count is 
+        not updated.
+
+        Returns a tuple containing a dictionary and a boolean array. The 
+        dictionary contains a boolean array for each filter that is in use, 
+        which is ``True`` for reads that fail the filter. The array is 
+        ``True`` for reads that fail any of the filters.
+        """
+        masks = dict()
+        filters = [x for x in filters if x in self.filters]
+        if 'chastity' in filters and self.filters['chastity']:
+            masks['chastity'] = ~batch.is_chaste()
+        if 'min quality' in filters and self.filters['min quality'] > 0:
+            masks['min quality'] = \
+                    batch.min_quality() < self.filters['min quality']
+        if 'avg quality' in filters and self.filters['avg quality'] > 0:
+            masks['avg quality'] = \
+                    batch.mean_quality() < self.filters['avg quality']
+
+        failed = np.zeros(len(batch), dtype=bool)
+        for key in masks:
+            self.filter_stats[key] += int(masks[key].sum())
+            failed |= masks[key]
+        return masks, failed
+
+
+    def report_filtered_batch(self, batch, masks, failed):
+        """
+        Calls :py:meth:`report_filtered_read` for each read in the 
+        :py:class:`~fqread.ReadBatch` *batch* that is ``True`` in the boolean 
+        array *failed*. The dictionary *masks* contains a boolean array for 
+        each filtering option (see :py:meth:`filter_batch`).
+        """
+        for i in np.flatnonzero(failed):
+            self.report_filtered_read(batch.read(i), 
+                                      dict((key, masks[key][i]) 
+                                           for key in masks))
+
+
     def write_all(self):
         self.write_data()
 
@@ -1,7 +1,88 @@
 import unittest
+import os
+import json
+import random
+import shutil
+import tempfile
+import numpy as np
 import seqlib
+from basic import BasicSeqLib
+from overlap import OverlapSeqLib
+from aligner import Aligner, EditDistance
+from fqread import read_fastq, read_fastq_batches
 from enrich_error import EnrichError
 
+
+# Wild type sequence used by the test libraries
+WT = "ATGAAAGCTCGTACCGGTTTAGAAGATCTGCACTGGAGCAAGCTGTTCGACCTGTAA"
+
+
+def write_fastq(fname, sequences, quality="I"):
+    """
+    Writes the *sequences* to the FASTQ file *fname* with a constant
+    *quality* value, or with the quality strings in the list *quality*. 
+    Returns *fname*.
+    """
+    with open(fname, "w") as handle:
+        for i, seq in enumerate(sequences):
+            if isinstance(quality, list):
+                qual = quality[i]
+            else:
+                qual = quality * len(seq)
+            handle.write("@read{i}\n{seq}\n+\n{qual}\n".format(i=i, seq=seq,
+                         qual=qual))
+    return fname
+
+
+def mutate(sequence, rng, edits):
+    """
+    Returns a copy of *sequence* with *edits* random substitutions, 
+    insertions, and deletions chosen using the :py:class:`random.Random` 
+    object *rng*.
+    """
+    sequence = list(sequence)
+    for _ in xrange(edits):
+        i = rng.randrange(len(sequence))
+        edit = rng.choice(("substitution", "insertion", "deletion"))
+        if edit == "substitution":
+            sequence[i] = rng.choice("ACGTN")
+        elif edit == "insertion":
+            sequence.insert(i, rng.choice("ACGT"))
+        elif len(sequence) > 1:
+            del sequence[i]
+    return "".join(sequence)
+
+
+def variant_reads(count, seed=0):
+    """
+    Returns a list of *count* reads derived from the wild type sequence with 
+    up to five random edits each. Some reads are repeated.
+    """
+    rng = random.Random(seed)
+    reads = list()
+    for _ in xrange(count):
+        if len(reads) > 0 and rng.random() < 0.2:
+            reads.append(rng.choice(reads))
+        else:
+            reads.append(mutate(WT, rng, rng.randint(0, 5)))
+    return reads
+
+
+def basic_config(directory, fastq, **kwargs):
+    """
+    Returns the JSON text of a :py:class:`~seqlib.basic.BasicSeqLib` config
+    that counts the reads in *fastq*. Additional top-level options are
+    given as *kwargs*.
+    """
+    config = {"name" : "test", "timepoint" : 0,
+              "output directory" : directory,
+              "wild type" : {"sequence" : WT, "coding" : True},
+              "fastq" : {"forward" : fastq},
+              "filters" : {"max mutations" : 3}}
+    config.update(kwargs)
+    return json.dumps(config)
+
+
 class SeqLibTests(unittest.TestCase):
 
     def setUp(self):
@@ -9,3 +90,419 @@ class SeqLibTests(unittest.TestCase):
 
     def test_config(self):
         pass
+
+
+class AlignerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.aligner = Aligner()
+
+    def test_unicode(self):
+        variant = WT[:10] + WT[11:]
+        self.assertEqual(self.aligner.align(unicode(WT), unicode(variant)),
+                         self.aligner.align(WT, variant))
+
+    def score(self, seq1, seq2, traceback):
+        """
+        Returns the score of the alignment *traceback* of *seq1* and *seq2*.
+        """
+        similarity = self.aligner.similarity
+        score = 0
+        for i, j, cat, length in traceback:
+            if cat in ("match", "mismatch"):
+                score += similarity[seq1[i]][seq2[j]]
+            else:
+                score += similarity['gap'] * length
+        return score
+
+    def best_score(self, seq1, seq2, semiglobal=False):
+        """
+        Returns the best alignment score of *seq1* and *seq2*, calculated 
+        one cell at a time.
+        """
+        similarity = self.aligner.similarity
+        gap = similarity['gap']
+        if semiglobal:
+            row = [0] * (len(seq2) + 1)
+        else:
+            row = [j * gap for j in xrange(len(seq2) + 1)]
+        for i in xrange(1, len(seq1) + 1):
+            previous = row
+            row = [i * gap]
+            for j in xrange(1, len(seq2) + 1):
+                row.append(max(previous[j - 1] + 
+                               similarity[seq1[i - 1]][seq2[j - 1]], 
+                               previous[j] + gap, row[j - 1] + gap))
+        if semiglobal:
+            return max(row)
+        else:
+            return row[-1]
+
+    def test_fill(self):
+        for variant in variant_reads(60):
+            traceback = self.aligner.align(WT, variant)
+            self.assertEqual(self.score(WT, variant, traceback), 
+                             self.best_score(WT, variant))
+            self.assertEqual(sum(t[3] or 1 for t in traceback 
+                                 if t[2] != "insertion"), len(WT))
+
+    def test_band(self):
+        for variant in variant_reads(60, seed=1):
+            expected = self.aligner.align(WT, variant)
+            for band in (0, 1, 3, 10):
+                self.assertEqual(self.aligner.align(WT, variant, band=band), 
+                                 expected)
+
+    def test_semiglobal(self):
+        rng = random.Random(2)
+        for variant in variant_reads(30, seed=2):
+            read = "".join(rng.choice("ACGT") for _ in xrange(7)) + \
+                    variant + "".join(rng.choice("ACGT") for _ in xrange(5))
+            traceback = self.aligner.align(WT, read, semiglobal=True)
+            self.assertEqual(self.score(WT, read, traceback), 
+                             self.best_score(WT, read, semiglobal=True))
+
+    def test_max_mutations(self):
+        for variant in variant_reads(30, seed=3):
+            traceback = self.aligner.align(WT, variant)
+            mutations = sum(1 for t in traceback if t[2] != "match")
+            for limit in (0, 2, 4):
+                result = self.aligner.align(WT, variant, max_mutations=limit)
+                if mutations > limit:
+                    self.assertIsNone(result)
+                else:
+                    self.assertEqual(result, traceback)
+
+    def test_unexpected_character(self):
+        self.assertRaises(KeyError, self.aligner.align, WT, WT[:5] + "Z")
+        self.assertRaises(KeyError, self.aligner.align, WT,
+                          unicode(WT[:5]) + u"\xe9")
+
+
+class EditDistanceTests(unittest.TestCase):
+
+    def levenshtein(self, seq1, seq2):
+        """
+        Returns the edit distance between *seq1* and *seq2*, calculated one 
+        cell at a time. ``'N'`` does not match anything.
+        """
+        row = range(len(seq2) + 1)
+        for i in xrange(1, len(seq1) + 1):
+            previous = row
+            row = [i]
+            for j in xrange(1, len(seq2) + 1):
+                same = seq1[i - 1] == seq2[j - 1] and seq1[i - 1] != "N"
+                row.append(min(previous[j - 1] + (0 if same else 1), 
+                               previous[j] + 1, row[j - 1] + 1))
+        return row[-1]
+
+    def test_distance(self):
+        edit_distance = EditDistance(WT)
+        reads = variant_reads(80, seed=4) + ["", "A", WT[:5], WT + WT, 
+                                             WT.lower(), "N" * len(WT)]
+        for read in reads:
+            expected = self.levenshtein(WT, read.upper())
+            self.assertEqual(edit_distance.distance(read), expected)
+            for limit in (0, 1, 3, 6):
+                result = edit_distance.distance(read, limit=limit)
+                if expected > limit:
+                    self.assertGreater(result, limit)
+                else:
+                    self.assertEqual(result, expected)
+
+
+class BasicSeqLibTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def library(self, sequences, **kwargs):
+        """
+        Returns a library built from a JSON config that has counted the
+        *sequences*.
+        """
+        fastq = write_fastq(os.path.join(self.directory, "reads.fq"),
+                            sequences)
+        lib = BasicSeqLib(json.loads(basic_config(self.directory, fastq,
+                                                  **kwargs)))
+        lib.calculate()
+        return lib
+
+    def count(self, sequences, **kwargs):
+        """
+        Counts the *sequences* using a library built from a JSON config and
+        returns a dictionary of variant counts.
+        """
+        lib = self.library(sequences, **kwargs)
+        return dict(lib.df_dict['variants']['count'])
+
+    def test_json_config(self):
+        mutant = WT[:3] + "G" + WT[4:]
+        counts = self.count([WT, WT, mutant, WT.lower()])
+        self.assertEqual(counts, {"_wt" : 3,
+                                  "c.4A>G (p.Lys2Glu)" : 1})
+
+    def test_align_processes(self):
+        reads = [WT, WT[:10] + WT[11:], WT[:20] + "CCCC" + WT[24:],
+                 WT[:30] + "T" + WT[30:], WT[:3] + "G" + WT[4:]]
+        expected = self.count(reads, **{"align variants" : True})
+        self.assertEqual(self.count(reads, **{"align variants" : True,
+                                              "align processes" : 2}),
+                         expected)
+        self.assertIn("c.30_31insT (p.Leu10fs)", expected)
+
+    def test_edit_prescreen(self):
+        deletion = WT[:20] + WT[25:]
+        mismatches = WT[:3] + "GGG" + WT[6:30] + "A" + WT[31:]
+        reads = [WT, deletion, mismatches, mismatches]
+        lib = self.library(reads, **{"align variants" : True})
+        self.assertEqual(lib.filter_stats['max mutations'], 2)
+        self.assertEqual(lib.filter_stats['edit prescreen'], 0)
+        self.assertEqual(lib.filter_stats['total'], 2)
+        lib = self.library(reads, **{"align variants" : True,
+                                     "filters" : {"max mutations" : 3,
+                                                  "edit prescreen" : True}})
+        self.assertEqual(lib.filter_stats['max mutations'], 0)
+        self.assertEqual(lib.filter_stats['edit prescreen'], 3)
+        self.assertEqual(lib.filter_stats['total'], 3)
+        self.assertEqual(dict(lib.df_dict['variants']['count']), {"_wt" : 1})
+
+    def test_seeded_alignment(self):
+        reads = [WT, WT[:20] + WT[23:], WT[:30] + "T" + WT[30:],
+                 WT[:3] + "GC" + WT[3:6] + "A" + WT[6:],
+                 WT[:53] + "AAA" + WT[53:], WT[:55] + "GA" + WT[55:],
+                 "TG" + WT, WT[1:], WT[:-2], "G" + WT[1:] + "GA"]
+        expected = self.count(reads, **{"align variants" : True})
+        self.assertEqual(self.count(reads, **{"align variants" : True,
+                                              "seeded alignment" : True}),
+                         expected)
+        flanked = ["GATTACAGATTACA" + r + "CCCGGGTTTAAACC" for r in reads[:3]]
+        self.assertEqual(self.count(flanked, **{"align variants" : True,
+                                                "seeded alignment" : True}),
+                         self.count(reads[:3], **{"align variants" : True}))
+
+    def test_protein_position(self):
+        reads = [WT[:3] + "G" + WT[4:], WT[:5] + "C" + WT[6:],
+                 WT[:10] + WT[11:]]
+        for offset in (0, 1, 2, 3, 31):
+            wild_type = {"sequence" : WT, "coding" : True,
+                         "reference offset" : offset}
+            nt = self.count(reads, **{"align variants" : True,
+                                      "wild type" : wild_type})
+            aa = self.count(reads, **{"align variants" : True,
+                                      "wild type" : wild_type,
+                                      "count level" : "protein"})
+            expected = set(v[v.index("(") + 1:-1] for v in nt)
+            self.assertEqual(set(aa), expected)
+            self.assertEqual(len(aa), 3)
+
+    def test_json_config_wild_type(self):
+        fastq = write_fastq(os.path.join(self.directory, "reads.fq"), [WT])
+        lib = BasicSeqLib(json.loads(basic_config(self.directory, fastq)))
+        self.assertIsInstance(lib.wt_dna, str)
+        self.assertEqual(len(lib.wt_codes), len(WT))
+
+
+class CountBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        reads = variant_reads(300, seed=5)
+        reads += [WT.lower(), WT[:20] + "n" + WT[21:], WT[:40] + "X" + WT[41:]]
+        self.fastq = write_fastq(os.path.join(self.directory, "reads.fq"),
+                                 reads)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def library(self, **kwargs):
+        lib = BasicSeqLib(json.loads(basic_config(self.directory, self.fastq,
+                                                  **kwargs)))
+        lib.df_dict['variants'] = dict()
+        if lib.aligner is not None:
+            lib.open_alignment_cache()
+        return lib
+
+    def check(self, **kwargs):
+        """
+        Checks that counting the reads in batches gives the same variant 
+        keys, counts, and discarded reads as counting them one at a time.
+        """
+        batch_lib = self.library(**kwargs)
+        excess = list()
+        for batch in read_fastq_batches(self.fastq, batch_size=37):
+            rows = np.ones(len(batch), dtype=bool)
+            rows[::5] = False
+            discarded, prescreened = batch_lib.count_batch(batch, rows)
+            self.assertFalse((discarded & ~rows).any())
+            excess.extend(zip(discarded[rows], prescreened[rows]))
+        read_lib = self.library(**kwargs)
+        expected = list()
+        for i, read in enumerate(read_fastq(self.fastq)):
+            if i % 37 % 5 != 0:
+                key = read_lib.count_variant(read.sequence)
+                expected.append((key is None, key is False))
+        self.assertEqual(batch_lib.df_dict['variants'], 
+                         read_lib.df_dict['variants'])
+        self.assertEqual(excess, expected)
+        self.assertIn(True, [x[0] or x[1] for x in expected])
+
+    def test_mismatches(self):
+        self.check()
+
+    def test_aligned(self):
+        self.check(**{"align variants" : True})
+
+    def test_prescreen(self):
+        self.check(**{"align variants" : True, 
+                      "filters" : {"max mutations" : 3, 
+                                   "edit prescreen" : True}})
+
+    def test_protein(self):
+        self.check(**{"align variants" : True, "count level" : "protein"})
+
+    def test_noncoding(self):
+        self.check(**{"align variants" : True, 
+                      "wild type" : {"sequence" : WT, "coding" : False}})
+
+
+class VariantKeyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fastq = write_fastq(os.path.join(self.directory, "reads.fq"), 
+                                 [WT])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def library(self, **kwargs):
+        return BasicSeqLib(json.loads(basic_config(self.directory, self.fastq,
+                                                   **kwargs)))
+
+    def test_coding(self):
+        lib = self.library()
+        variant = WT[:3] + "G" + WT[4:8] + "C" + WT[9:]
+        key = lib.variant_key(variant, [(3, "A>G"), (8, "T>C")])
+        self.assertEqual(key, ((3, "A>G", "E"), (8, "T>C", "A")))
+        self.assertEqual(lib.format_variant(key), 
+                         "c.4A>G (p.Lys2Glu), c.9T>C (p.=)")
+        self.assertEqual(lib.format_variant(()), "_wt")
+        self.assertEqual(lib.format_protein_variant(lib.protein_key(key)), 
+                         "p.Lys2Glu")
+        key = lib.variant_key(WT[:10] + WT[11:], [(10, "_11del")])
+        self.assertEqual(key, ((10, "_11del", None),))
+        self.assertEqual(lib.format_variant(key), 
+                         "c.11_11del (p.Arg4fs)")
+        self.assertEqual(lib.protein_key(key), ((3, None),))
+
+    def test_noncoding(self):
+        lib = self.library(**{"wild type" : {"sequence" : WT, 
+                                             "coding" : False, 
+                                             "reference offset" : 100}})
+        key = lib.variant_key(WT[:3] + "G" + WT[4:], [(3, "A>G")])
+        self.assertEqual(key, ((3, "A>G"),))
+        self.assertEqual(lib.format_variant(key), "n.104A>G")
+
+    def test_count_variant(self):
+        lib = self.library(**{"align variants" : True})
+        lib.df_dict['variants'] = dict()
+        lib.open_alignment_cache()
+        self.assertEqual(lib.count_variant(WT), ())
+        self.assertEqual(lib.count_variant(WT[:10] + WT[11:]), 
+                         ((10, "_11del", None),))
+        self.assertIsNone(lib.count_variant("T" * len(WT)))
+        self.assertEqual(lib.df_dict['variants'], 
+                         {() : 1, ((10, "_11del", None),) : 1})
+        lib.format_variants()
+        self.assertEqual(lib.df_dict['variants'], 
+                         {"_wt" : 1, "c.11_11del (p.Arg4fs)" : 1})
+
+
+def overlap_reads(count, seed=0):
+    """
+    Returns lists of forward and reverse reads, and their quality strings, 
+    for *count* read pairs derived from the wild type sequence. The forward 
+    reads contain the first 45 bases and the reverse reads contain the 
+    reverse complement of the last 45 bases, so the 33 bases starting at 
+    position 13 overlap. Some bases in each read are changed, so that some 
+    mismatches are resolved by quality, some are unresolvable, and some 
+    read pairs cannot be merged.
+    """
+    rng = random.Random(seed)
+    complement = dict(zip("ACGTN", "TGCAN"))
+    reads = ([], [], [], [])
+    for _ in xrange(count):
+        fwd = list(WT[:45])
+        rev = list("".join(complement[b] for b in reversed(WT[12:])))
+        for _ in xrange(rng.randint(0, 2)):
+            fwd[rng.randrange(len(fwd))] = rng.choice("ACGTN")
+        for _ in xrange(rng.randint(0, 2)):
+            rev[rng.randrange(len(rev))] = rng.choice("ACGTN")
+        reads[0].append("".join(fwd))
+        reads[1].append("".join(rev))
+        reads[2].append("".join(rng.choice("#5?I") for _ in fwd))
+        reads[3].append("".join(rng.choice("#5?I") for _ in rev))
+    return reads
+
+
+class MergeBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check(self, fwd_reads, rev_reads, fwd_quality, rev_quality, 
+              overlap_only=False):
+        """
+        Checks that merging the reads in batches gives the same merged reads 
+        and failures as merging each read pair.
+        """
+        forward = write_fastq(os.path.join(self.directory, "fwd.fq"), 
+                              fwd_reads, fwd_quality)
+        reverse = write_fastq(os.path.join(self.directory, "rev.fq"), 
+                              rev_reads, rev_quality)
+        config = {"name" : "test", "timepoint" : 0, 
+                  "output directory" : self.directory, 
+                  "wild type" : {"sequence" : WT, "coding" : True},
+                  "fastq" : {"forward" : forward, "reverse" : reverse},
+                  "overlap" : {"forward start" : 13, "reverse start" : 13, 
+                               "length" : 33, "max mismatches" : 1, 
+                               "overlap only" : overlap_only},
+                  "filters" : {}}
+        lib = OverlapSeqLib(json.loads(json.dumps(config)))
+        merged = list()
+        for fwd, rev in zip(read_fastq_batches(forward, batch_size=16), 
+                            read_fastq_batches(reverse, batch_size=16)):
+            batch, failed = lib.merge_batch(fwd, rev)
+            merged.extend(None if failed[i] else str(batch.read(i)) 
+                          for i in xrange(len(batch)))
+        expected = list()
+        for fwd, rev in zip(read_fastq(forward), read_fastq(reverse)):
+            merge = lib.merge_reads(fwd, rev)
+            expected.append(None if merge is None else str(merge))
+        self.assertEqual(merged, expected)
+        self.assertIn(None, expected)
+        self.assertTrue(any("X" in m.split("\n")[1] for m in expected 
+                            if m is not None))
+
+    def test_fixed_length(self):
+        self.check(*overlap_reads(100))
+
+    def test_overlap_only(self):
+        self.check(*overlap_reads(100, seed=1), overlap_only=True)
+
+    def test_variable_length(self):
+        fwd, rev, fwd_quality, rev_quality = overlap_reads(100, seed=2)
+        fwd[7] = fwd[7] + "ACG"
+        fwd_quality[7] = fwd_quality[7] + "III"
+        self.check(fwd, rev, fwd_quality, rev_quality)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,51 @@
 
 from __future__ import print_function
 import re
+import os.path
+from itertools import product
+import logging
+import hashlib
+import json
+import shelve
 from sys import stdout, stderr
 from enrich_error import EnrichError
-from aligner import Aligner
+from aligner import Aligner, AlignmentCache, EditDistance, SeedIndex, \
+        align_parallel, align_pool
 from seqlib import SeqLib
 import pandas as pd
+import numpy as np
 
 
 # Variant string for counting wild type sequences
 WILD_TYPE_VARIANT = "_wt"
 
+# Variant string for counting synonymous variants at the protein level
+SYNONYMOUS_VARIANT = "_sy"
+
+# Values of the 'count level' config option
+COUNT_LEVELS = ("nucleotide", "protein", "both")
+
+# Upper-case ASCII value for each character, used on encoded sequences
+_upper_ascii = np.arange(256, dtype=np.uint8)
+_upper_ascii[ord('a'):ord('z') + 1] -= ord('a') - ord('A')
+
+# Characters allowed in upper-case variant sequences
+_valid_ascii = np.zeros(256, dtype=bool)
+_valid_ascii[np.frombuffer("ACGTNX", dtype=np.uint8)] = True
+
+# Bases matched by each IUPAC nucleotide code, used for designed libraries
+_iupac_bases = {
+        'A' : "A", 'C' : "C", 'G' : "G", 'T' : "T",
+        'R' : "AG", 'Y' : "CT", 'S' : "CG", 'W' : "AT", 'K' : "GT", 'M' : "AC",
+        'B' : "CGT", 'D' : "AGT", 'H' : "ACT", 'V' : "ACG", 'N' : "ACGT"
+}
+
+# Subdirectory of the output directory used for the persistent alignment cache
+ALIGNMENT_CACHE_DIR = "alignment_cache"
+
+# Default number of alignments kept in memory by each library
+ALIGNMENT_CACHE_ENTRIES = 100000
+
 # Standard codon table for translating wild type and variant DNA sequences
 codon_table = {
         'TTT':'F', 'TCT':'S', 'TAT':'Y', 'TGT':'C',
@@ -59,12 +94,39 @@ aa_codes = {
 }
 
 
+# Index of each base in the codon table for encoded sequences (others are 4)
+_base_index = np.empty(256, dtype=np.intp)
+_base_index.fill(4)
+for i, base in enumerate("ACGT"):
+    _base_index[ord(base)] = i
+
+# Amino acid for each codon index (25 * first + 5 * second + third base)
+_codon_aa = np.empty(125, dtype="S1")
+_codon_aa.fill('?')
+for codon, aa in codon_table.iteritems():
+    _codon_aa[np.dot(_base_index[np.frombuffer(codon, dtype=np.uint8)], 
+                     (25, 5, 1))] = aa
+
+
+def translate_codes(codes):
+    """
+    Translates the upper-case DNA sequences encoded as ASCII values in the 
+    two-dimensional ``uint8`` array *codes* (one row per sequence, with a 
+    length that is a multiple of three). Returns an array of single 
+    characters with one column per codon. Codons that contain characters 
+    other than ``ACGT`` are translated as ``'?'``.
+    """
+    index = _base_index[codes]
+    return _codon_aa[index[:, 0::3] * 25 + index[:, 1::3] * 5 + 
+                     index[:, 2::3]]
+
+
 def has_indel(variant):
     """
     Helper function that returns ``True`` if the HGVS string *variant* 
-    contains an indel mutation.
+    contains an indel mutation (or a frameshift, for protein-level variants).
     """
-    return any(x in variant for x in ("ins", "del", "dup"))
+    return any(x in variant for x in ("ins", "del", "dup", "fs"))
 
 
 class VariantSeqLib(SeqLib):
@@ -79,6 +141,18 @@ class VariantSeqLib(SeqLib):
         self.wt_protein = None
         self.aligner = None
         self.aligner_cache = None
+        self.edit_distance = None
+        self.seed_index = None
+        self.anchor_cache = None
+        self.align_processes = 1
+        self.align_pool = None
+        self.alignment_cache_dir = None
+        self.alignment_cache_entries = ALIGNMENT_CACHE_ENTRIES
+        self.alignment_store = None
+        self.alignment_store_hits = 0
+        self.alignment_store_misses = 0
+        self.design_table = None
+        self.count_level = "nucleotide"
 
         try:
             self.set_wt(config['wild type']['sequence'], 
@@ -86,10 +160,43 @@ class VariantSeqLib(SeqLib):
             if 'align variants' in config:
                 if config['align variants']:
                     self.aligner = Aligner()
-                    self.aligner_cache = dict()
+                    self.edit_distance = EditDistance(self.wt_dna)
+            if 'alignment cache' in config:
+                self.alignment_cache_dir = config['alignment cache']
+            if 'alignment cache entries' in config:
+                self.alignment_cache_entries = \
+                        int(config['alignment cache entries'])
+                if self.alignment_cache_entries < 1:
+                    raise ValueError(config['alignment cache entries'])
+            if self.aligner is not None:
+                self.aligner_cache = AlignmentCache(self.alignment_cache_entries)
+                if config.get('seeded alignment', False):
+                    self.seed_index = SeedIndex(self.wt_dna)
+                    self.anchor_cache = \
+                            AlignmentCache(self.alignment_cache_entries)
+            if 'align processes' in config:
+                self.align_processes = int(config['align processes'])
+                if self.align_processes < 1:
+                    raise ValueError(config['align processes'])
+            if 'count level' in config:
+                if config['count level'] not in COUNT_LEVELS:
+                    raise ValueError(config['count level'])
+                self.count_level = config['count level']
+                if self.count_level != "nucleotide" and not self.is_coding():
+                    raise EnrichError("Protein-level counting requires a "
+                                      "coding wild type sequence", self.name)
+            if 'designed library' in config:
+                design = config['designed library']
+                self.set_design(design['mutagenesis'], 
+                                positions=design.get('positions'), 
+                                degenerate_codon=design.get('degenerate codon', 
+                                                            "NNN"))
 
         except KeyError as key:
-            raise EnrichError("Missing required config value '{key}'".format(key), 
+            raise EnrichError("Missing required config value '{key}'".format(key=key), 
+                              self.name)
+        except ValueError as value:
+            raise EnrichError("Invalid parameter value {value}".format(value=value), 
                               self.name)
 
         if 'reference offset' in config['wild type']:
@@ -102,6 +209,8 @@ class VariantSeqLib(SeqLib):
             self.reference_offset = 0
 
         self.df_dict['variants'] = None
+        if self.count_level == "both":
+            self.df_dict['variants_aa'] = None
 
 
     def is_coding(self):
@@ -123,7 +232,9 @@ class VariantSeqLib(SeqLib):
             raise EnrichError("WT DNA sequence contains incomplete codons", 
                               self.name)
         
-        self.wt_dna = sequence.upper()
+        # config values loaded from JSON are unicode
+        self.wt_dna = str(sequence.upper())
+        self.wt_codes = np.frombuffer(self.wt_dna, dtype=np.uint8)
         if coding:
             self.wt_protein = ""
             for i in xrange(0, len(self.wt_dna), 3):
@@ -132,21 +243,223 @@ class VariantSeqLib(SeqLib):
             self.wt_protein = None
 
 
-    def align_variant(self, variant_dna):
+    def set_design(self, mutagenesis, positions=None, degenerate_codon="NNN"):
+        """
+        Precomputes the variant key (see :py:meth:`variant_key`) for every 
+        sequence expected in a designed library, including the wild type. 
+        The wild type sequence must already be set.
+
+        If *mutagenesis* is ``"codon"``, each of the codons numbered in 
+        *positions* is replaced by every codon matching the IUPAC 
+        *degenerate_codon* (such as ``"NNK"``). If *mutagenesis* is 
+        ``"nucleotide"``, each of the bases numbered in *positions* is 
+        replaced by each of the other three bases. Positions are numbered 
+        from 1 at the start of the wild type sequence. If *positions* is 
+        ``None``, all codons or bases are mutagenized.
+        """
+        if mutagenesis == "codon":
+            if len(self.wt_dna) % 3 != 0:
+                raise EnrichError("Codon mutagenesis requires complete codons", 
+                                  self.name)
+            degenerate_codon = degenerate_codon.upper()
+            if len(degenerate_codon) != 3 or \
+                    not all(x in _iupac_bases for x in degenerate_codon):
+                raise EnrichError("Invalid degenerate codon '{codon}'".format(codon=degenerate_codon), 
+                                  self.name)
+            size = 3
+            replacements = ["".join(x) for x in 
+                            product(*(_iupac_bases[x] for x in degenerate_codon))]
+        elif mutagenesis == "nucleotide":
+            size = 1
+            replacements = list("ACGT")
+        else:
+            raise EnrichError("Invalid mutagenesis type '{mutagenesis}'".format(mutagenesis=mutagenesis), 
+                              self.name)
+        sites = len(self.wt_dna) / size
+        if positions is None:
+            positions = xrange(1, sites + 1)
+
+        self.design_table = {self.wt_dna : tuple()}
+        for p in positions:
+            try:
+                p = int(p)
+            except ValueError:
+                raise EnrichError("Invalid designed position '{p}'".format(p=p), 
+                                  self.name)
+            if p < 1 or p > sites:
+                raise EnrichError("Designed position {p} is outside the wild type sequence".format(p=p), 
+                                  self.name)
+            start = (p - 1) * size
+            for r in replacements:
+                variant_dna = self.wt_dna[:start] + r + \
+                              self.wt_dna[start + size:]
+                if variant_dna not in self.design_table:
+                    mutations = [(i, "{pre}>{post}".format(pre=self.wt_dna[i], post=variant_dna[i]))
+                                 for i in xrange(start, start + size)
+                                 if variant_dna[i] != self.wt_dna[i]]
+                    self.design_table[variant_dna] = \
+                            self.variant_key(variant_dna, mutations)
+        logging.info("Designed library contains {n} expected variants [{name}]".format(n=len(self.design_table), name=self.name))
+
+
+    def design_key(self, variant_dna):
+        """
+        Returns the precomputed variant key for the upper-case *variant_dna* 
+        sequence if it is expected in the designed library (see 
+        :py:meth:`set_design`) and has no more than ``'max mutations'`` 
+        mutations. Otherwise, returns ``None`` and the variant is called 
+        normally.
+        """
+        if self.design_table is None:
+            return None
+        key = self.design_table.get(variant_dna)
+        if key is not None and len(key) > self.filters['max mutations']:
+            return None
+        return key
+
+
+    def alignment_cache_filename(self):
+        """
+        Returns the name of the persistent alignment cache file. The name 
+        contains a hash of the wild type sequence, the 
+        :py:class:`~seqlib.aligner.Aligner` similarity matrix (including the 
+        gap penalty), and the ``'max mutations'`` filter value, so libraries 
+        only share cached alignments if the results would be the same.
+
+        If the ``'alignment cache'`` config option is ``True``, the cache is 
+        stored in the ``ALIGNMENT_CACHE_DIR`` subdirectory of the output 
+        directory. Otherwise, the option is the name of the cache directory.
+        """
+        if self.alignment_cache_dir is True:
+            directory = os.path.join(self.output_base, ALIGNMENT_CACHE_DIR)
+        else:
+            directory = self.alignment_cache_dir
+        key = json.dumps([self.wt_dna, self.aligner.similarity, 
+                          self.filters['max mutations']], sort_keys=True)
+        return os.path.join(directory, "alignments_{digest}.db".format(
+                            digest=hashlib.sha1(key).hexdigest()[:16]))
+
+
+    def open_alignment_cache(self):
+        """
+        Opens the persistent alignment cache (see 
+        :py:meth:`alignment_cache_filename`) if the ``'alignment cache'`` 
+        config option is set and the cache is not already open.
+        """
+        if self.alignment_cache_dir in (None, False) or \
+                self.alignment_store is not None:
+            return
+        fname = self.alignment_cache_filename()
+        try:
+            if not os.path.exists(os.path.dirname(fname)):
+                os.makedirs(os.path.dirname(fname))
+            self.alignment_store = shelve.open(fname, protocol=2)
+        except Exception:
+            raise EnrichError("Failed to open alignment cache '{fname}'".format(fname=fname), 
+                              self.name)
+        self.alignment_store_hits = 0
+        self.alignment_store_misses = 0
+
+
+    def load_alignment(self, variant_dna):
+        """
+        Copies the alignment result for *variant_dna* from the persistent 
+        alignment cache into the local alignment cache and returns it. Raises 
+        a ``KeyError`` if the *variant_dna* was not found.
+        """
+        if self.alignment_store is None:
+            raise KeyError(variant_dna)
+        try:
+            mutations = self.alignment_store[variant_dna]
+        except KeyError:
+            self.alignment_store_misses += 1
+            raise
+        self.alignment_store_hits += 1
+        self.aligner_cache[variant_dna] = mutations
+        return mutations
+
+
+    def close_alignment_cache(self):
+        """
+        Logs the local alignment cache statistics and clears the cache to save 
+        memory, and logs the hit rate and closes the persistent alignment 
+        cache if it is open.
+        """
+        logging.info("Alignment cache: {stats} [{name}]".format(
+                     stats=self.aligner_cache.stats(), name=self.name))
+        self.aligner_cache = AlignmentCache(self.alignment_cache_entries)
+        if self.anchor_cache is not None:
+            self.anchor_cache = AlignmentCache(self.alignment_cache_entries)
+        if self.alignment_store is not None:
+            lookups = self.alignment_store_hits + self.alignment_store_misses
+            logging.info("Persistent alignment cache: {hits} hits, {misses} misses "
+                         "({rate:.1%} hit rate) [{name}]".format(
+                         hits=self.alignment_store_hits, 
+                         misses=self.alignment_store_misses, 
+                         rate=float(self.alignment_store_hits) / max(lookups, 1),
+                         name=self.name))
+            self.alignment_store.close()
+            self.alignment_store = None
+
+
+    def align_variant(self, variant_dna, max_mutations=None):
         """
         Use the local :py:class:`~seqlib.aligner.Aligner` instance to align the *variant_dna* to the 
-        wild type sequence. Returns a list of HGVS variant strings.
+        wild type sequence. Returns a list of HGVS variant strings, or ``None`` if 
+        *max_mutations* is not ``None`` and the alignment has more mutations.
 
-        Aligned variants are stored in a local dictionary to avoid recomputing alignments. This 
-        dictionary should be cleared after all variants are counted, to save memory.
+        The alignment is banded using the ``'max mutations'`` filter value (see 
+        :py:meth:`~seqlib.aligner.Aligner.align`).
+
+        Aligned variants are stored in a local :py:class:`~seqlib.aligner.AlignmentCache` to 
+        avoid recomputing alignments. The cache holds a limited number of the most recently 
+        used variants, and should be cleared after all variants are counted, to save memory (see 
+        :py:meth:`close_alignment_cache`). If the persistent alignment cache is enabled, it 
+        is checked before aligning, and new alignments are added to it.
 
         .. warning:: Using the :py:class:`~seqlib.aligner.Aligner` dramatically increases runtime.
         """
-        if variant_dna in self.aligner_cache.keys():
+        try:
             return self.aligner_cache[variant_dna]
+        except KeyError:
+            pass
+        self.open_alignment_cache()
+        try:
+            return self.load_alignment(variant_dna)
+        except KeyError:
+            pass
+
+        traceback = self.aligner.align(self.wt_dna, variant_dna, 
+                                       band=self.filters['max mutations'], 
+                                       max_mutations=max_mutations)
+        return self.cache_alignment(variant_dna, traceback)
+
+
+    def cache_alignment(self, variant_dna, traceback):
+        """
+        Converts the *traceback* returned by 
+        :py:meth:`~seqlib.aligner.Aligner.align` for the *variant_dna* into a 
+        list of HGVS variant strings, stores it in the local and persistent 
+        alignment caches, and returns it. If the *traceback* is ``None`` (the 
+        variant has too many mutations), ``None`` is stored and returned.
+        """
+        if traceback is None: # too many mutations
+            mutations = None
+        else:
+            mutations = self.traceback_mutations(variant_dna, traceback)
+        self.aligner_cache[variant_dna] = mutations
+        if self.alignment_store is not None:
+            self.alignment_store[variant_dna] = mutations
+        return mutations
+
+
+    def traceback_mutations(self, variant_dna, traceback):
+        """
+        Returns a list of HGVS variant strings for the *variant_dna* 
+        described by the alignment *traceback*.
+        """
 
         mutations = list()
-        traceback = self.aligner.align(self.wt_dna, variant_dna)
         for x, y, cat, length in traceback:
             if cat == "match":
                 continue
@@ -158,17 +471,186 @@ class VariantSeqLib(SeqLib):
                     if dup == variant_dna[y - length:y]:
                         mut = "dup{seq}".format(seq=dup)
                     else:
-                        mut = "_{pos}ins{seq}".format(post=x + 2, seq=dup)
+                        mut = "_{pos}ins{seq}".format(pos=x + 2, seq=dup)
                 else:                                    
                     mut = "_{pos}ins{seq}".format(pos=x + 2, seq=variant_dna[y:y + length])
             elif cat == "deletion":
                 mut = "_{pos}del".format(pos=x + length)
             mutations.append((x, mut))
-
-        self.aligner_cache[variant_dna] = mutations
         return mutations
 
 
+    def anchor_variant(self, variant_dna):
+        """
+        Returns the part of the *variant_dna* read that corresponds to the 
+        wild type sequence, for reads that contain flanking sequence.
+
+        The read is anchored using the wild type k-mers it contains (see 
+        :py:class:`~seqlib.aligner.SeedIndex`). Only the diagonals with the 
+        most k-mer hits or more than one hit are used, so that chance 
+        matches in the flanking sequence are ignored. Reads without any 
+        matching k-mers, whose k-mers do not place any sequence outside the 
+        wild type, or whose edit distance from the wild type is no more than 
+        ``'max mutations'`` are returned unchanged. If the k-mers agree and 
+        the anchored sequence has no more than ``'max mutations'`` 
+        mismatches, it is returned without alignment. Otherwise, the wild 
+        type is aligned to the window of the read implied by the k-mers 
+        (extended by ``'max mutations'`` bases on each side to allow for 
+        indels) using :py:meth:`~seqlib.aligner.Aligner.align` in 
+        semi-global mode, and the aligned part of the window is returned. 
+        Mutations in the returned sequence are filtered by 
+        :py:meth:`count_variant` as usual.
+
+        Insertions near either end of the wild type sequence cannot be 
+        distinguished from flanking sequence, and may not be reported unless 
+        the read has no flanks and the edit distance is small enough.
+        """
+        try:
+            return self.anchor_cache[variant_dna]
+        except KeyError:
+            pass
+
+        n = len(self.wt_dna)
+        limit = self.filters['max mutations']
+        diagonals = self.seed_index.diagonals(variant_dna)
+        if len(diagonals) > 0:
+            best = max(diagonals.itervalues())
+            diagonals = [d for d, hits in diagonals.iteritems() 
+                         if hits > 1 or hits == best]
+        if len(diagonals) == 0:
+            anchored = variant_dna
+        elif min(diagonals) <= 0 and max(diagonals) + n >= len(variant_dna):
+            anchored = variant_dna # no flanking sequence
+        elif self.edit_distance.distance(variant_dna, limit=limit) <= limit:
+            anchored = variant_dna # differences can be explained by mutations
+        else:
+            lo = min(diagonals)
+            hi = max(diagonals)
+            anchored = None
+            if lo == hi and 0 <= lo <= len(variant_dna) - n:
+                anchored = variant_dna[lo:lo + n]
+                mismatches = sum(1 for a, b in zip(anchored, self.wt_dna) 
+                                 if a != b)
+                if mismatches > limit:
+                    anchored = None
+            if anchored is None:
+                start = max(0, lo - limit)
+                window = variant_dna[start:hi + n + limit]
+                traceback = self.aligner.align(self.wt_dna, window, 
+                                               semiglobal=True)
+                first = None
+                last = None
+                for x, y, cat, length in traceback or list():
+                    if cat == "deletion":
+                        continue
+                    elif cat == "insertion":
+                        y_end = y + length
+                    else:
+                        y_end = y + 1
+                    if first is None:
+                        first = y
+                    last = y_end
+                if first is None: # wild type is entirely deleted
+                    anchored = variant_dna
+                else:
+                    anchored = window[first:last]
+
+        self.anchor_cache[variant_dna] = anchored
+        return anchored
+
+
+    def align_variants(self, variants):
+        """
+        Aligns the distinct sequences in the iterable *variants* that 
+        :py:meth:`count_variant` would align, using a pool of worker 
+        processes (see :py:func:`~seqlib.aligner.align_parallel`), and stores 
+        the results in the alignment cache so that counting does not wait 
+        for each alignment. Does nothing unless the ``'align processes'`` 
+        config option is greater than 1.
+
+        Sequences are aligned in the order they first appear, and the 
+        results are identical to aligning them one at a time.
+        """
+        if self.aligner is None or self.align_processes < 2:
+            return
+
+        self.open_alignment_cache()
+        limit = self.filters['max mutations']
+        seen = set(self.aligner_cache)
+        pending = list()
+        for variant_dna in variants:
+            variant_dna = variant_dna.upper()
+            if variant_dna in seen:
+                continue
+            seen.add(variant_dna)
+            if not re.match("^[ACGTNX]+$", variant_dna):
+                continue # reported by count_variant
+            variant_dna = str(variant_dna)
+            if self.seed_index is not None and \
+                    len(variant_dna) != len(self.wt_dna):
+                anchored = self.anchor_variant(variant_dna)
+                if anchored != variant_dna:
+                    if anchored in seen:
+                        continue
+                    variant_dna = anchored
+                    seen.add(variant_dna)
+            if len(variant_dna) != len(self.wt_dna):
+                max_mutations = None
+            elif (np.frombuffer(variant_dna, dtype=np.uint8) != 
+                  self.wt_codes).sum() > limit:
+                max_mutations = limit
+            else:
+                continue # not aligned
+            if self.prescreen_variant(variant_dna):
+                try:
+                    self.load_alignment(variant_dna)
+                except KeyError:
+                    pending.append((variant_dna, max_mutations))
+
+        jobs = [(self.wt_dna, v, limit, m) for v, m in pending]
+        if len(jobs) > 0 and self.align_pool is None:
+            self.align_pool = align_pool(self.aligner, self.align_processes)
+        tracebacks = align_parallel(self.aligner, jobs, self.align_processes, 
+                                    pool=self.align_pool)
+        for (variant_dna, _), traceback in zip(pending, tracebacks):
+            self.cache_alignment(variant_dna, traceback)
+
+
+    def close_align_pool(self):
+        """
+        Closes the pool of worker processes created by 
+        :py:meth:`align_variants`, if there is one. The pool is created the 
+        first time it is needed and shared by all the batches of reads 
+        counted by :py:meth:`calculate`.
+        """
+        if self.align_pool is not None:
+            self.align_pool.close()
+            self.align_pool.join()
+            self.align_pool = None
+
+
+    def prescreen_variant(self, variant_dna):
+        """
+        Returns ``False`` if the ``'edit prescreen'`` filter is enabled and the 
+        edit distance between the *variant_dna* and the wild type sequence is 
+        greater than the ``'max mutations'`` filter value, so that the variant 
+        can be discarded without performing an alignment.
+
+        The edit distance is not a lower bound on the number of mutations. It 
+        counts each inserted or deleted base, whereas an indel of any length 
+        is a single mutation after alignment, so the pre-screen is stricter 
+        than ``'max mutations'`` and also discards variants with long indels.
+        """
+        if not self.filters.get('edit prescreen', False) or \
+                variant_dna in self.aligner_cache:
+            return True
+        limit = self.filters['max mutations']
+        if self.edit_distance.distance(variant_dna, limit=limit) > limit:
+            return False
+        else:
+            return True
+
+
     def count_variant(self, variant_dna, copies=1, include_indels=True):
         """
         Identifies mutations and counts the *variant_dna* sequence.
@@ -176,21 +658,39 @@ class VariantSeqLib(SeqLib):
         If the *variant_dna* and wild type DNA are different lengths, or if there
         are an excess of mismatches (indicating a possible indel), local
         alignment is performed using :py:meth:`align_variant` if this option 
-        has been selected in the configuration.
+        has been selected in the configuration. Variants may be discarded 
+        before alignment by :py:meth:`prescreen_variant`. If seeded alignment 
+        is enabled, reads that are not the same length as the wild type are 
+        first trimmed using :py:meth:`anchor_variant`.
 
-        Each variant is stored as a tab-delimited string of mutations in HGVS 
-        format. Returns a list of HGSV variant strings. Returns an empty list 
+        Sequences expected in a designed library are counted without calling 
+        mutations (see :py:meth:`design_key`).
+
+        Each variant is counted using :py:meth:`record_variant`. Returns the 
+        variant key (see :py:meth:`format_variant`), which is an empty tuple 
         if the variant is wild type. Returns None if the variant was discarded
-        due to excess mismatches.
+        due to excess mismatches, or ``False`` if it was discarded by 
+        :py:meth:`prescreen_variant` before alignment. Discarded variants are 
+        not added to the filter counts.
         """
         if not re.match("^[ACGTNXacgtnx]+$", variant_dna):
             raise EnrichError("Variant DNA sequence contains unexpected "
                               "characters", self.name)
 
-        variant_dna = variant_dna.upper()
+        variant_dna = str(variant_dna.upper())
+        key = self.design_key(variant_dna)
+        if key is not None:
+            self.record_key(key, copies)
+            return key
+
+        if self.seed_index is not None and \
+                len(variant_dna) != len(self.wt_dna):
+            variant_dna = self.anchor_variant(variant_dna)
 
         if len(variant_dna) != len(self.wt_dna):
             if self.aligner is not None:
+                if not self.prescreen_variant(variant_dna):
+                    return False
                 mutations = self.align_variant(variant_dna)
             else:
                 return None
@@ -201,8 +701,11 @@ class VariantSeqLib(SeqLib):
                     mutations.append((i, "{pre}>{post}".format(pre=self.wt_dna[i], post=variant_dna[i])))
                     if len(mutations) > self.filters['max mutations']:
                         if self.aligner is not None:
-                            mutations = self.align_variant(variant_dna)
-                            if len(mutations) > self.filters['max mutations']:
+                            if not self.prescreen_variant(variant_dna):
+                                return False
+                            mutations = self.align_variant(variant_dna, 
+                                    max_mutations=self.filters['max mutations'])
+                            if mutations is None:
                                 # too many mutations post-alignment
                                 return None
                             else:
@@ -212,42 +715,288 @@ class VariantSeqLib(SeqLib):
                             # too many mutations and not using aligner
                             return None
 
-        mutation_strings = list()
+        return self.record_variant(variant_dna, mutations, copies)
+
+
+    def variant_key(self, variant_dna, mutations, variant_protein=None):
+        """
+        Returns the key used to count the variant with the *mutations* found 
+        in the upper-case *variant_dna* sequence. The *mutations* are a list 
+        of ``(position, change)`` tuples, as returned by 
+        :py:meth:`align_variant`.
+
+        While counting, variants are identified by a tuple with an entry for 
+        each mutation, which is converted to an HGVS variant string by 
+        :py:meth:`format_variants` when counting is finished. For coding 
+        sequences, each entry also contains the variant amino acid for 
+        substitutions (``None`` for indels), so the variant protein is not 
+        needed later.
+
+        For coding sequences, the *variant_protein* translation can be 
+        provided (see :py:func:`translate_codes`). Otherwise, only the codons 
+        that contain mutations are translated.
+        """
         if self.is_coding():
-            variant_protein = ""
-            for i in xrange(0, len(variant_dna), 3):
-                try:
-                    variant_protein += codon_table[variant_dna[i:i + 3]]
-                except KeyError: # garbage codon due to indel
-                    variant_protein += '?'
+            if variant_protein is None:
+                variant_protein = dict()
+                for pos, change in mutations:
+                    i = pos - pos % 3
+                    if i / 3 not in variant_protein:
+                        # garbage codons due to indels are '?'
+                        variant_protein[i / 3] = \
+                                codon_table.get(variant_dna[i:i + 3], '?')
+            return tuple((pos, change, None) if has_indel(change) else 
+                         (pos, change, variant_protein[pos / 3])
+                         for pos, change in mutations)
+        else:
+            return tuple(mutations)
+
+
+    def record_variant(self, variant_dna, mutations, copies=1, 
+                       variant_protein=None):
+        """
+        Adds *copies* to the count of the variant with the *mutations* found 
+        in the upper-case *variant_dna* sequence. Returns the variant key 
+        (see :py:meth:`variant_key`).
+        """
+        key = self.variant_key(variant_dna, mutations, variant_protein)
+        self.record_key(key, copies)
+        return key
+
 
-            for pos, change in mutations:
+    def record_key(self, key, copies=1):
+        """
+        Adds *copies* to the count of the variant *key*. If the ``'count 
+        level'`` is ``"protein"``, the count is added to the protein-level 
+        variant instead (see :py:meth:`protein_key`).
+        """
+        if self.count_level == "protein":
+            key = self.protein_key(key)
+        try:
+            self.df_dict['variants'][key] += copies
+        except KeyError:
+            self.df_dict['variants'][key] = copies
+
+
+    def format_variant(self, key):
+        """
+        Returns the HGVS variant string for the variant *key* created by 
+        :py:meth:`record_variant`. Mutations are separated by commas.
+        """
+        mutation_strings = list()
+        if self.is_coding():
+            for pos, change, variant_aa in key:
                 ref_dna_pos = pos + self.reference_offset + 1
-                ref_pro_pos = (pos + self.reference_offset) / 3 + 1
+                ref_pro_pos = self.protein_position(pos / 3)
                 mut = "c.{pos}{change}".format(pos=ref_dna_pos, change=change)
-                if has_indel(change):
+                if variant_aa is None: # indel
                     mut += " (p.{pre}{pos}fs)".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos)
-                elif variant_protein[pos / 3] == self.wt_protein[pos / 3]:
+                elif variant_aa == self.wt_protein[pos / 3]:
                     mut += " (p.=)"
                 else:
                     mut += " (p.{pre}{pos}{post})".format(pre=aa_codes[self.wt_protein[pos / 3]], pos=ref_pro_pos,
-                             post=aa_codes[variant_protein[pos / 3]])
+                             post=aa_codes[variant_aa])
                 mutation_strings.append(mut)
         else:
-            for pos, change in mutations:
+            for pos, change in key:
                 ref_dna_pos = pos + self.reference_offset + 1
                 mut = "n.{pos}{change}".format(pos=ref_dna_pos, change=change)
                 mutation_strings.append(mut)
 
         if len(mutation_strings) > 0:
-            variant_string = ', '.join(mutation_strings)
+            return ', '.join(mutation_strings)
         else:
-            variant_string = WILD_TYPE_VARIANT
-        try:
-            self.df_dict['variants'][variant_string] += copies
-        except KeyError:
-            self.df_dict['variants'][variant_string] = copies
-        return variant_string
+            return WILD_TYPE_VARIANT
+
+
+    def protein_position(self, codon):
+        """
+        Returns the position in the reference protein of the wild type 
+        *codon* (numbered from 0), taking the ``'reference offset'`` into 
+        account. Used by :py:meth:`format_variant` and 
+        :py:meth:`format_protein_variant`, so every base in a codon has the 
+        same protein position.
+        """
+        return (codon * 3 + self.reference_offset) / 3 + 1
+
+
+    def protein_key(self, key):
+        """
+        Returns the protein-level key for the nucleotide variant *key* created 
+        by :py:meth:`variant_key`. The protein-level key is a tuple with a 
+        ``(codon, amino acid)`` entry for each changed codon, where the amino 
+        acid is ``None`` for frameshifts. Returns ``SYNONYMOUS_VARIANT`` if 
+        the variant has only synonymous changes.
+        """
+        changes = list()
+        for pos, change, variant_aa in key:
+            codon = pos / 3
+            if variant_aa != self.wt_protein[codon] and \
+                    (codon, variant_aa) not in changes:
+                changes.append((codon, variant_aa))
+        if len(changes) == 0 and len(key) > 0:
+            return SYNONYMOUS_VARIANT
+        return tuple(changes)
+
+
+    def format_protein_variant(self, key):
+        """
+        Returns the HGVS protein variant string for the protein-level *key* 
+        created by :py:meth:`protein_key`. Changes are separated by commas.
+        """
+        if key == SYNONYMOUS_VARIANT:
+            return SYNONYMOUS_VARIANT
+        mutation_strings = list()
+        for codon, variant_aa in key:
+            ref_pro_pos = self.protein_position(codon)
+            if variant_aa is None: # indel
+                mut = "p.{pre}{pos}fs".format(pre=aa_codes[self.wt_protein[codon]], pos=ref_pro_pos)
+            else:
+                mut = "p.{pre}{pos}{post}".format(pre=aa_codes[self.wt_protein[codon]], pos=ref_pro_pos,
+                        post=aa_codes[variant_aa])
+            mutation_strings.append(mut)
+
+        if len(mutation_strings) > 0:
+            return ', '.join(mutation_strings)
+        else:
+            return WILD_TYPE_VARIANT
+
+
+    def variant_string(self, key):
+        """
+        Returns the string used to identify the variant *key* created by 
+        :py:meth:`variant_key` in the ``'variants'`` data. This is the 
+        protein variant string if the ``'count level'`` is ``"protein"`` and 
+        the HGVS variant string otherwise.
+        """
+        if self.count_level == "protein":
+            return self.format_protein_variant(self.protein_key(key))
+        else:
+            return self.format_variant(key)
+
+
+    def format_variants(self):
+        """
+        Replaces the variant keys in the ``'variants'`` count dictionary with 
+        HGVS variant strings (see :py:meth:`format_variant` and 
+        :py:meth:`format_protein_variant`). Each distinct variant is formatted 
+        once.
+
+        If the ``'count level'`` is ``"both"``, the nucleotide variant counts 
+        are also combined into protein variant counts, which are stored in the 
+        ``'variants_aa'`` data.
+        """
+        if self.count_level == "protein":
+            format_fn = self.format_protein_variant
+        else:
+            format_fn = self.format_variant
+
+        if self.count_level == "both":
+            counts = dict()
+            for key, count in self.df_dict['variants'].iteritems():
+                variant_string = self.format_protein_variant(
+                        self.protein_key(key))
+                try:
+                    counts[variant_string] += count
+                except KeyError:
+                    counts[variant_string] = count
+            if len(counts) == 0:
+                raise EnrichError("Failed to count variants", self.name)
+            self.df_dict['variants_aa'] = \
+                    pd.DataFrame.from_dict(counts, orient="index", 
+                                           dtype="int32")
+            self.df_dict['variants_aa'].columns = ['count']
+            self.df_dict['variants_aa'].sort('count', ascending=False, 
+                                             inplace=True)
+
+        counts = dict()
+        for key, count in self.df_dict['variants'].iteritems():
+            variant_string = format_fn(key)
+            try:
+                counts[variant_string] += count
+            except KeyError:
+                counts[variant_string] = count
+        self.df_dict['variants'] = counts
+
+
+    def count_batch(self, batch, rows):
+        """
+        Counts the variants for the reads in *rows* (a boolean array or an 
+        array of read indices) of the :py:class:`~fqread.ReadBatch` *batch*. 
+        Returns two boolean arrays that are ``True`` for reads that were 
+        discarded due to excess mutations and for reads that were discarded by 
+        :py:meth:`prescreen_variant`, respectively. Each discarded read is in 
+        only one of the arrays.
+
+        Each distinct sequence is counted once (see 
+        :py:meth:`~fqread.ReadBatch.unique_sequences`). Sequences expected in 
+        a designed library are looked up first (see :py:meth:`design_key`). 
+        The other distinct sequences that are the same length as the wild type are compared to the wild 
+        type in a single array operation, and those with valid characters 
+        and no more than ``'max mutations'`` mismatches are counted 
+        directly. The remaining sequences are counted using 
+        :py:meth:`count_variant`, which aligns them if alignment is enabled.
+        """
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        sequences, copies, inverse = batch.unique_sequences(rows)
+        rejected = np.zeros(len(sequences), dtype=bool)
+        prescreened = np.zeros(len(sequences), dtype=bool)
+        done = np.zeros(len(sequences), dtype=bool)
+        self.align_variants(sequences)
+
+        if self.design_table is not None:
+            for i in xrange(len(sequences)):
+                key = self.design_key(sequences[i])
+                if key is not None:
+                    self.record_key(key, int(copies[i]))
+                    done[i] = True
+
+        n = len(self.wt_dna)
+        limit = self.filters['max mutations']
+        fixed = np.flatnonzero(np.fromiter((len(x) == n for x in sequences), 
+                                           dtype=bool, count=len(sequences)) 
+                               & ~done)
+        if len(fixed) > 0:
+            codes = np.frombuffer("".join(sequences[i] for i in fixed), 
+                                  dtype=np.uint8).reshape(len(fixed), n)
+            codes = _upper_ascii[codes]
+            valid = _valid_ascii[codes].all(axis=1)
+            mismatches = codes != self.wt_codes
+            counts = mismatches.sum(axis=1)
+            passed = np.flatnonzero(valid & (counts <= limit))
+            if self.is_coding():
+                proteins = translate_codes(codes[passed])
+            for j, k in enumerate(passed):
+                variant_dna = codes[k].tostring()
+                mutations = [(i, "{pre}>{post}".format(pre=self.wt_dna[i], 
+                                                       post=variant_dna[i]))
+                             for i in np.flatnonzero(mismatches[k])]
+                if self.is_coding():
+                    variant_protein = proteins[j].tostring()
+                else:
+                    variant_protein = None
+                self.record_variant(variant_dna, mutations, 
+                                    copies=int(copies[fixed[k]]), 
+                                    variant_protein=variant_protein)
+            done[fixed[valid & (counts <= limit)]] = True
+            if self.aligner is None: # too many mutations and not aligning
+                rejected[fixed[valid & (counts > limit)]] = True
+                done[fixed[valid & (counts > limit)]] = True
+
+        for i in np.flatnonzero(~done):
+            mutations = self.count_variant(sequences[i], copies=int(copies[i]))
+            if mutations is None: # read has too many mutations
+                rejected[i] = True
+            elif mutations is False: # read failed the edit distance prescreen
+                prescreened[i] = True
+
+        excess = np.zeros(len(batch), dtype=bool)
+        excess[rows] = rejected[inverse]
+        discarded = np.zeros(len(batch), dtype=bool)
+        discarded[rows] = prescreened[inverse]
+        return excess, discarded
 
 
     def count_mutations(self, include_indels=False):
@@ -255,55 +1004,37 @@ class VariantSeqLib(SeqLib):
         Count the individual mutations in all variants. If *include_indels* is ``False``, all mutations in a variant that contains 
         an insertion/deletion/duplication will not be counted. For coding sequences, amino acid substitutions are counted
         independently of the corresponding nucleotide change.
+
+        The counts are summed over the parsed variant table (see 
+        :py:meth:`~datacontainer.DataContainer.variant_table`), which has one 
+        row for each mutation. The results are stored 
+        with a ``'count'`` column in the data frames 'mutations_nt' and 
+        'mutations_aa' (coding sequences only). If the ``'count level'`` is 
+        ``"protein"``, only 'mutations_aa' is created.
         """
         # restore the counts if they were saved to disk
         if self.df_dict['variants'] is None:
             self.load_counts(keys=['variants'])
 
-        # create new dictionaries
-        self.df_dict['mutations_nt'] = dict()
-        if self.is_coding():
-            self.df_dict['mutations_aa'] = dict()
-
+        # one row for each mutation in each variant
+        table = self.variant_table('variants')
         if not include_indels:
-            mask = self.df_dict['variants'].index.map(has_indel)
-            variant_data = self.df_dict['variants'][np.invert(mask)]
-            del mask
-        else:
-            variant_data = self.df_dict['variants']
-        if self.is_coding():
-            for variant, count in variant_data.iterrows():
-                count = count['count'] # get the element from the Series
-                mutations = variant.split(", ")
-                # get just the nucleotide changes
-                for m in mutations:
-                    m = m.split(" (")[0]
-                    try:
-                        self.df_dict['mutations_nt'][m] += count
-                    except KeyError:
-                        self.df_dict['mutations_nt'][m] = count
-                # get the amino acid changes
-                aa_changes = re.findall("p\.[A-Z][a-z][a-z]\d+[A-Z][a-z][a-z]", variant)
-                for a in aa_changes:
-                    try:
-                        self.df_dict['mutations_aa'][a] += count
-                    except KeyError:
-                        self.df_dict['mutations_aa'][a] = count
-        else:
-            for variant, count in variant_data.iterrows():
-                count = count['count'] # get the element from the Series
-                mutations = variant.split(", ")
-                for m in mutations:
-                    try:
-                        self.df_dict['mutations_nt'][m] += count
-                    except KeyError:
-                        self.df_dict['mutations_nt'][m] = count
-
-        self.df_dict['mutations_nt'] = \
-                pd.DataFrame.from_dict(self.df_dict['mutations_nt'], 
-                                       orient="index", dtype="int32")
+            indel_variants = table['variant'][table['indel'].values].unique()
+            table = table[~table['variant'].isin(indel_variants)]
+        counts = self.df_dict['variants']['count'].reindex(
+                table['variant'].values).values
+
         if self.is_coding():
+            # get the amino acid changes
+            aa_mask = table['mut_aa'].notnull().values
             self.df_dict['mutations_aa'] = \
-                    pd.DataFrame.from_dict(self.df_dict['mutations_aa'], 
-                                           orient="index", dtype="int32")
+                    pd.DataFrame({'count' : pd.Series(counts[aa_mask]).groupby(
+                                  table['aa'].values[aa_mask]).sum()}, 
+                                 dtype="int32")
+        if self.count_level != "protein":
+            # get just the nucleotide changes
+            nt_changes = table['nt'].fillna(table['mutation'])
+            self.df_dict['mutations_nt'] = \
+                    pd.DataFrame({'count' : pd.Series(counts).groupby(
+                                  nt_changes.values).sum()}, dtype="int32")
 
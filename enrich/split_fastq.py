@@ -2,10 +2,26 @@ from __future__ import print_function
 from sys import stderr
 import argparse
 import os.path
-from fqread import read_fastq_multi
+from fqread import read_fastq_multi, FastqWriter
+from compression import OUTPUT_COMPRESSION, strip_compression_extension
 
 
-def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
+def output_name(outdir, fname, sequence, compression=None):
+    """
+    Returns the name of the output file in *outdir* for reads from *fname* 
+    matching the index *sequence*. The file extension is changed to match 
+    the output *compression*.
+    """
+    name, ext = os.path.splitext(os.path.basename(
+                                 strip_compression_extension(fname)))
+    name = "{name}_{seq}{ext}".format(name=name, seq=sequence, ext=ext)
+    if compression is not None:
+        name += OUTPUT_COMPRESSION[compression]
+    return os.path.join(outdir, name)
+
+
+def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches,
+                compression=None):
     """
     """
     if index is None:
@@ -17,56 +33,34 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
         return
 
     # build an iterator to process the files in parallel
-    fq_handles = dict() # output file handles and index read sequences
+    fq_handles = dict() # output files for each index read sequence
     if forward is not None and reverse is not None:
         fq_iterator = read_fastq_multi([index, forward, reverse], 
                                        match_lengths=True)
         for s in sequences:
-            name, ext = os.path.splitext(os.path.basename(index))
-            index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
-            index_name = os.path.join(outdir, index_name)
-
-            name, ext = os.path.splitext(os.path.basename(forward))
-            forward_name = "{name}_{seq}{ext}".format(name=name, seq=s, 
-                                                      ext=ext)
-            forward_name = os.path.join(outdir, forward_name)
-
-            name, ext = os.path.splitext(os.path.basename(reverse))
-            reverse_name = "{name}_{seq}{ext}".format(name=name, seq=s, 
-                                                      ext=ext)
-            reverse_name = os.path.join(outdir, reverse_name)
-
             fq_handles[s] = \
-                (open(index_name, "w"), open(forward_name, "w"),
-                 open(reverse_name, "w"))
+                (FastqWriter(output_name(outdir, index, s, compression), 
+                             compression),
+                 FastqWriter(output_name(outdir, forward, s, compression), 
+                             compression),
+                 FastqWriter(output_name(outdir, reverse, s, compression), 
+                             compression))
     elif forward is not None:
         fq_iterator = read_fastq_multi([index, forward], match_lengths=True)
         for s in sequences:
-            name, ext = os.path.splitext(os.path.basename(index))
-            index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
-            index_name = os.path.join(outdir, index_name)
-
-            name, ext = os.path.splitext(os.path.basename(forward))
-            forward_name = "{name}_{seq}{ext}".format(name=name, seq=s, 
-                                                      ext=ext)
-            forward_name = os.path.join(outdir, forward_name)
-
             fq_handles[s] = \
-                (open(index_name, "w"), open(forward_name, "w"))
+                (FastqWriter(output_name(outdir, index, s, compression), 
+                             compression),
+                 FastqWriter(output_name(outdir, forward, s, compression), 
+                             compression))
     elif reverse is not None:
         fq_iterator = read_fastq_multi([index, reverse], match_lengths=True)
         for s in sequences:
-            name, ext = os.path.splitext(os.path.basename(index))
-            index_name = "{name}_{seq}{ext}".format(name=name, seq=s, ext=ext)
-            index_name = os.path.join(outdir, index_name)
-
-            name, ext = os.path.splitext(os.path.basename(reverse))
-            reverse_name = "{name}_{seq}{ext}".format(name=name, seq=s, 
-                                                      ext=ext)
-            reverse_name = os.path.join(outdir, reverse_name)
-
             fq_handles[s] = \
-                (open(index_name, "w"), open(reverse_name, "w"))
+                (FastqWriter(output_name(outdir, index, s, compression), 
+                             compression),
+                 FastqWriter(output_name(outdir, reverse, s, compression), 
+                             compression))
     else:
         print("Error: no forward or reverse files specified for split_fastq",
               file=stderr)
@@ -92,7 +86,7 @@ def split_fastq(outdir, sequences, index, forward, reverse, max_mismatches):
 
         if match:
             for i in xrange(len(t)):
-                print(t[i], file=fq_handles[match][i])
+                fq_handles[match][i].write(t[i])
 
     # close all the files
     for handle_tuple in fq_handles.values():
@@ -116,9 +110,12 @@ if __name__ == "__main__":
     parser.add_argument("-m", "--mismatches", metavar="N",
                         help="index read mismatch threshold",
                         type=int, default=0)
+    parser.add_argument("-z", "--compress", 
+                        choices=sorted(OUTPUT_COMPRESSION.keys()),
+                        help="output compression format")
 
     args = parser.parse_args()
 
     split_fastq(args.output, args.sequences, args.index, args.forward, 
-                args.reverse, args.mismatches)
+                args.reverse, args.mismatches, args.compress)
     
\ No newline at end of file
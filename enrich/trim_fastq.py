@@ -2,10 +2,11 @@ from __future__ import print_function
 from sys import stderr
 import argparse
 import os.path
-from fqread import read_fastq
+from fqread import read_fastq, FastqWriter
+from compression import OUTPUT_COMPRESSION, strip_compression_extension
 
 
-def trim_fastq(outdir, files, start, end, length):
+def trim_fastq(outdir, files, start, end, length, compression=None):
     """
     """
     if len(files) == 0:
@@ -30,16 +31,19 @@ def trim_fastq(outdir, files, start, end, length):
             start = 1
 
     for f in files:
-        name, ext = os.path.splitext(os.path.basename(f))
+        name, ext = os.path.splitext(os.path.basename(
+                                     strip_compression_extension(f)))
         outfile_name = name + ".trim" + ext
+        if compression is not None:
+            outfile_name += OUTPUT_COMPRESSION[compression]
         outfile_name = os.path.join(outdir, outfile_name)
-        with open(outfile_name, "w") as handle:
+        with FastqWriter(outfile_name, compression) as writer:
             for read in read_fastq(f):
                 if length_mode:
                     read.trim_length(length, start)
                 else:
                     read.trim(start, end)
-                print(read, file=handle)
+                writer.write(read)
 
 
 
@@ -55,8 +59,12 @@ if __name__ == "__main__":
                         help="length of trim region", type=int)
     parser.add_argument("-o", "--output", default=".", metavar="DIR",
                         help="output directory")
+    parser.add_argument("-z", "--compress", 
+                        choices=sorted(OUTPUT_COMPRESSION.keys()),
+                        help="output compression format")
 
     args = parser.parse_args()
 
-    trim_fastq(args.output, args.files, args.start, args.end, args.length)
+    trim_fastq(args.output, args.files, args.start, args.end, args.length, 
+               args.compress)
     
\ No newline at end of file
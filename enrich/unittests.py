@@ -0,0 +1,363 @@
+import unittest
+import os
+import bz2
+import gzip
+import random
+import shutil
+import tempfile
+import collections
+import numpy as np
+import pandas as pd
+from enrich_error import EnrichError
+from index_fastq import FastqIndex, index_fastq, convert_to_bgzf
+from fqread import read_fastq, read_fastq_multi, read_fastq_multi_batches, \
+        read_fastq_batches
+from compression import BgzfWriter, is_bgzf, open_bgzf, BGZF_BLOCK_SIZE
+from datacontainer import parse_variants
+
+
+def fastq_text(count, length=20):
+    """
+    Returns the text of a FASTQ file containing *count* records of the
+    given *length*. Each record has a different sequence and quality string.
+    """
+    records = list()
+    for i in xrange(count):
+        seq = "".join("ACGT"[(i >> (2 * j)) % 4] for j in xrange(length))
+        qual = "".join(chr(33 + (i + j) % 41) for j in xrange(length))
+        records.append("@read{i}\n{seq}\n+\n{qual}\n".format(i=i, seq=seq,
+                       qual=qual))
+    return "".join(records)
+
+
+def casava_fastq_text(count, seed=0):
+    """
+    Returns the text of a FASTQ file containing *count* records with Casava 
+    1.8 headers, random sequences of different lengths, and random quality 
+    values. Some sequences are repeated.
+    """
+    rng = random.Random(seed)
+    records = list()
+    sequences = list()
+    for i in xrange(count):
+        if len(sequences) > 0 and rng.random() < 0.3:
+            seq = rng.choice(sequences)
+        else:
+            seq = "".join(rng.choice("ACGTN") 
+                          for _ in xrange(rng.randint(0, 30)))
+            sequences.append(seq)
+        qual = "".join(chr(rng.randint(33, 126)) for _ in seq)
+        records.append("@M1:1:FC1:1:1:{i}:1 1:{flag}:0:ACGT\n{seq}\n+\n"
+                       "{qual}\n".format(i=i, flag=rng.choice("YN"), seq=seq, 
+                                         qual=qual))
+    return "".join(records)
+
+
+class ReadBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, "reads.fq")
+        with open(self.fname, "w") as handle:
+            handle.write(casava_fastq_text(200))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pairs(self):
+        """
+        Yields a tuple containing each :py:class:`~fqread.ReadBatch` and a 
+        list of the same records read one at a time.
+        """
+        reads = list(read_fastq(self.fname))
+        start = 0
+        for batch in read_fastq_batches(self.fname, batch_size=23):
+            yield batch, reads[start:start + len(batch)]
+            start += len(batch)
+        self.assertEqual(start, len(reads))
+
+    def assertSameReads(self, batch, reads):
+        self.assertEqual([str(batch.read(i)) for i in xrange(len(batch))], 
+                         [str(r) for r in reads])
+        self.assertEqual([batch.sequence(i) for i in xrange(len(batch))], 
+                         [r.sequence for r in reads])
+
+    def test_reads(self):
+        for batch, reads in self.pairs():
+            self.assertSameReads(batch, reads)
+            self.assertEqual(batch.is_chaste().tolist(), 
+                             [r.is_chaste() for r in reads])
+
+    def test_quality(self):
+        for batch, reads in self.pairs():
+            nonempty = batch.lengths > 0
+            self.assertEqual(batch.min_quality()[nonempty].tolist(), 
+                             [r.min_quality() for r in reads if len(r) > 0])
+            self.assertEqual(batch.mean_quality()[nonempty].tolist(), 
+                             [r.mean_quality() for r in reads if len(r) > 0])
+            self.assertEqual(batch.qualities.dtype, np.int8)
+
+    def test_revcomp(self):
+        for batch, reads in self.pairs():
+            batch.revcomp()
+            for r in reads:
+                r.revcomp()
+            self.assertSameReads(batch, reads)
+
+    def test_trim(self):
+        for batch, reads in self.pairs():
+            batch.trim(3, 20)
+            for r in reads:
+                r.trim(3, 20)
+            self.assertSameReads(batch, reads)
+            batch.trim_length(5, start=2)
+            for r in reads:
+                r.trim_length(5, start=2)
+            self.assertSameReads(batch, reads)
+
+    def test_select(self):
+        for batch, reads in self.pairs():
+            rows = np.arange(len(batch)) % 3 == 1
+            self.assertSameReads(batch.select(rows), 
+                                 [r for r, x in zip(reads, rows) if x])
+
+    def test_unique_sequences(self):
+        for batch, reads in self.pairs():
+            rows = np.arange(len(batch)) % 4 != 0
+            sequences, counts, inverse = batch.unique_sequences(rows)
+            expected = collections.Counter(r.sequence for r, x in 
+                                           zip(reads, rows) if x)
+            self.assertEqual(dict(zip(sequences, counts.tolist())), expected)
+            self.assertEqual([sequences[i] for i in inverse], 
+                             [r.sequence for r, x in zip(reads, rows) if x])
+
+
+class ParseVariantsTests(unittest.TestCase):
+
+    def test_parse(self):
+        variants = ["_wt", "c.4A>G (p.Lys2Glu), c.9T>C (p.=)", 
+                    "c.11_11del (p.Arg4fs)", "n.104A>G", 
+                    "p.Lys2Glu, p.Trp12???", "_sy"]
+        table = parse_variants(pd.Index(variants))
+        self.assertEqual(list(table.columns), 
+                         ['variant', 'mutation', 'nt', 'nt_position', 'aa', 
+                          'aa_position', 'wt_aa', 'mut_aa', 'indel'])
+        rows = [dict((k, v) for k, v in row.iteritems() if pd.notnull(v))
+                for _, row in table.iterrows()]
+        expected = [
+            {'variant' : "_wt", 'mutation' : "_wt", 'indel' : False},
+            {'variant' : variants[1], 'mutation' : "c.4A>G (p.Lys2Glu)", 
+             'nt' : "c.4A>G", 'nt_position' : 4, 'aa' : "p.Lys2Glu", 
+             'aa_position' : 2, 'wt_aa' : "Lys", 'mut_aa' : "Glu", 
+             'indel' : False},
+            {'variant' : variants[1], 'mutation' : "c.9T>C (p.=)", 
+             'nt' : "c.9T>C", 'nt_position' : 9, 'aa' : "p.=", 
+             'indel' : False},
+            {'variant' : variants[2], 'mutation' : variants[2], 
+             'nt' : "c.11_11del", 'nt_position' : 11, 'aa' : "p.Arg4fs", 
+             'aa_position' : 4, 'wt_aa' : "Arg", 'indel' : True},
+            {'variant' : "n.104A>G", 'mutation' : "n.104A>G", 
+             'nt' : "n.104A>G", 'nt_position' : 104, 'indel' : False},
+            {'variant' : variants[4], 'mutation' : "p.Lys2Glu", 
+             'aa' : "p.Lys2Glu", 'aa_position' : 2, 'wt_aa' : "Lys", 
+             'mut_aa' : "Glu", 'indel' : False},
+            {'variant' : variants[4], 'mutation' : "p.Trp12???", 
+             'aa' : "p.Trp12???", 'aa_position' : 12, 'wt_aa' : "Trp", 
+             'indel' : False},
+            {'variant' : "_sy", 'mutation' : "_sy", 'indel' : False}]
+        self.assertEqual(rows, expected)
+
+    def test_empty(self):
+        table = parse_variants(pd.Index([]))
+        self.assertEqual(len(table), 0)
+
+
+class BgzfWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fname = os.path.join(self.directory, "data.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        rng = random.Random(0)
+        # compressible text followed by data that does not compress
+        data = fastq_text(5000) + \
+                "".join(chr(rng.randint(0, 255)) for _ in xrange(100000))
+        writer = BgzfWriter(self.fname)
+        offsets = list()
+        pos = 0
+        for size in (1, 10, BGZF_BLOCK_SIZE, 70000, 5, 3 * BGZF_BLOCK_SIZE):
+            offsets.append((pos, writer.tell()))
+            writer.write(data[pos:pos + size])
+            pos += size
+        offsets.append((pos, writer.tell()))
+        writer.write(data[pos:])
+        writer.close()
+
+        self.assertTrue(is_bgzf(self.fname))
+        handle = gzip.open(self.fname, "rb")
+        self.assertEqual(handle.read(), data)
+        handle.close()
+        for pos, voffset in offsets:
+            reader = open_bgzf(self.fname, voffset)
+            self.assertEqual(reader.read(1000), data[pos:pos + 1000])
+            reader.close()
+
+    def test_empty(self):
+        BgzfWriter(self.fname).close()
+        self.assertTrue(is_bgzf(self.fname))
+        handle = gzip.open(self.fname, "rb")
+        self.assertEqual(handle.read(), "")
+        handle.close()
+
+
+class IndexFastqTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        fname = os.path.join(self.directory, name)
+        with open(fname, "wb") as handle:
+            handle.write(data)
+        return fname
+
+    def test_bz2(self):
+        data = bz2.compress(fastq_text(50))
+        for name in ("reads.fq.bz2", "reads.fq"):
+            fname = self.write(name, data)
+            self.assertRaises(EnrichError, index_fastq, fname, interval=10)
+            self.assertFalse(os.path.exists(fname + ".fqi"))
+
+    def write_gzip(self, name, data):
+        fname = os.path.join(self.directory, name)
+        handle = gzip.open(fname, "wb")
+        handle.write(data)
+        handle.close()
+        return fname
+
+    def test_plain_gzip(self):
+        data = fastq_text(50)
+        for name in ("reads.fq.gz", "reads.fq"):
+            fname = self.write_gzip(name, data)
+            self.assertRaises(EnrichError, index_fastq, fname, interval=10)
+            self.assertFalse(os.path.exists(fname + ".fqi"))
+
+    def test_bgzf(self):
+        fname = self.write_gzip("reads.fq.gz", fastq_text(50))
+        expected = [str(r) for r in read_fastq(fname)]
+        outname = os.path.join(self.directory, "reads.bgzf.fq.gz")
+        index = convert_to_bgzf(fname, outname, interval=10)
+        self.assertEqual(len(index), 50)
+        self.assertEqual(index_fastq(outname, interval=10).offsets,
+                         index.offsets)
+        for start, end in ((0, 50), (10, 20), (13, 47), (40, None)):
+            self.assertEqual([str(r) for r in read_fastq(outname,
+                              start_record=start, end_record=end)],
+                             expected[start:end])
+
+    def test_stale_gzip_index(self):
+        data = fastq_text(50)
+        fname = self.write("reads.fq", data)
+        index = index_fastq(fname, interval=10)
+        gzname = self.write_gzip("reads.fq.gz", data)
+        index.size = os.path.getsize(gzname)
+        index.write(gzname + ".fqi")
+        self.assertEqual([str(r) for r in read_fastq(gzname,
+                          start_record=25)],
+                         [str(r) for r in read_fastq(fname,
+                          start_record=25)])
+
+    def test_uncompressed(self):
+        fname = self.write("reads.fq", fastq_text(50))
+        expected = [str(r) for r in read_fastq(fname)]
+        index_fastq(fname, interval=10)
+        for start, end in ((0, 50), (10, 20), (13, 47), (40, None)):
+            self.assertEqual([str(r) for r in read_fastq(fname,
+                              start_record=start, end_record=end)],
+                             expected[start:end])
+
+    def test_index_file(self):
+        fname = self.write("reads.fq", fastq_text(55))
+        index = index_fastq(fname, interval=10)
+        self.assertEqual(len(index), 55)
+        self.assertEqual(len(index.offsets), 6)
+        with open(fname, "rb") as handle:
+            for i, offset in enumerate(index.offsets):
+                handle.seek(offset)
+                self.assertEqual(handle.readline(), 
+                                 "@read{i}\n".format(i=i * 10))
+        saved = FastqIndex.load(fname)
+        self.assertEqual((saved.interval, saved.records, saved.size, 
+                          saved.offsets), 
+                         (10, 55, os.path.getsize(fname), index.offsets))
+        self.assertEqual(index.locate(0), (0, index.offsets[0]))
+        self.assertEqual(index.locate(37), (30, index.offsets[3]))
+        self.assertEqual(index.locate(55), (50, index.offsets[5]))
+        self.assertRaises(IndexError, index.locate, 56)
+        self.assertEqual(index.shards(3), [(0, 20), (20, 40), (40, 55)])
+        self.assertEqual(index.shards(100)[-1], (50, 55))
+
+    def test_stale_index(self):
+        fname = self.write("reads.fq", fastq_text(30))
+        index_fastq(fname, interval=10)
+        self.write("reads.fq", fastq_text(31))
+        self.assertRaises(IOError, FastqIndex.load, fname)
+        self.write("reads.fq.fqi", "not an index\n")
+        self.assertRaises(IOError, FastqIndex.read, fname + ".fqi")
+
+    def test_bgzf_offsets(self):
+        fname = self.write_gzip("reads.fq.gz", fastq_text(500, length=200))
+        outname = os.path.join(self.directory, "reads.bgzf.fq.gz")
+        index = convert_to_bgzf(fname, outname, interval=7)
+        self.assertEqual(len(index), 500)
+        for i, voffset in enumerate(index.offsets):
+            reader = open_bgzf(outname, voffset)
+            self.assertTrue(reader.read(20).startswith(
+                            "@read{i}\n".format(i=i * 7)))
+            reader.close()
+
+    def test_empty(self):
+        index = index_fastq(self.write("empty.fq", ""), interval=10)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.locate(0), (0, 0))
+        self.assertRaises(IndexError, index.locate, 1)
+        self.assertRaises(EnrichError, FastqIndex(10, 5, 100, []).locate, 3)
+
+
+class ReadFastqMultiTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fnames = list()
+        for i, count in enumerate((30, 30)):
+            fname = os.path.join(self.directory, "reads{i}.fq".format(i=i))
+            with open(fname, "w") as handle:
+                handle.write(fastq_text(count, length=20 + i))
+            self.fnames.append(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_prefetch(self):
+        expected = [tuple(str(r) for r in records)
+                    for records in read_fastq_multi(self.fnames)]
+        self.assertEqual(len(expected), 30)
+        self.assertEqual([tuple(str(r) for r in records) for records in
+                          read_fastq_multi(self.fnames, prefetch=True)],
+                         expected)
+        batches = read_fastq_multi_batches(self.fnames, batch_size=7,
+                                           prefetch=True)
+        self.assertEqual([tuple(str(b.read(i)) for b in pair)
+                          for pair in batches for i in xrange(len(pair[0]))],
+                         expected)
+
+
+if __name__ == "__main__":
+    unittest.main()